@@ -0,0 +1,212 @@
+"""
+Small in-process caches shared by the routers.
+
+Every cache here lives in one worker process. run.py starts WEB_CONCURRENCY
+workers, and the invalidate_* helpers only clear the calling worker's copy, so
+after a write the other workers can serve the old entry until its TTL runs out.
+Keep TTLs short, and don't cache reads that must see the caller's own writes.
+"""
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    Bounded mapping whose entries expire `ttl` seconds after they are stored.
+    When full, the least recently used entry is evicted. Safe to use from both
+    the event loop and FastAPI's threadpool.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING:
+                return default
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any, ttl: float | None = None) -> None:
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.pop(key, _MISSING)
+        return default if entry is _MISSING else entry[1]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class StaleWhileRevalidateCache:
+    """
+    Async cache for slow-changing reads.
+
+    Entries younger than `ttl` are served as-is. Entries older than `ttl` but
+    younger than `stale_ttl` are still served immediately while a background
+    task reloads them. Anything older is loaded in the request path.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, stale_ttl: float):
+        self.ttl = ttl
+        self._entries = TTLCache(maxsize=maxsize, ttl=stale_ttl)
+        self._refreshing: set[Hashable] = set()
+        self._tasks: set[asyncio.Task] = set()
+
+    async def get_or_load(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        entry = self._entries.get(key, _MISSING)
+        if entry is not _MISSING:
+            fetched_at, value = entry
+            if time.monotonic() - fetched_at >= self.ttl and key not in self._refreshing:
+                self._refreshing.add(key)
+                task = asyncio.create_task(self._refresh(key, loader))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+            return value
+
+        value = await loader()
+        self.set(key, value)
+        return value
+
+    async def _refresh(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> None:
+        try:
+            self.set(key, await loader())
+        except Exception:
+            pass  # Keep serving the stale value; the next read retries
+        finally:
+            self._refreshing.discard(key)
+
+    def set(self, key: Hashable, value: Any) -> None:
+        self._entries.set(key, (time.monotonic(), value))
+
+    def invalidate(self, key: Hashable) -> None:
+        self._entries.pop(key)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+
+class SingleFlight:
+    """
+    Collapses concurrent calls for the same key into one: while a load for a
+    key is in flight, later callers await its result instead of starting their
+    own. Results are reused for `linger` seconds after completion, so bursts
+    that arrive just after the first call finishes are merged too.
+    """
+
+    def __init__(self, linger: float = 0.0, maxsize: int = 10_000):
+        self._inflight: dict[Hashable, asyncio.Future] = {}
+        self._recent = TTLCache(maxsize=maxsize, ttl=linger) if linger > 0 else None
+
+    async def do(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        if self._recent is not None:
+            value = self._recent.get(key, _MISSING)
+            if value is not _MISSING:
+                return value
+
+        future = self._inflight.get(key)
+        if future is not None:
+            # shield: one waiter going away must not cancel the shared load
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await loader()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # Mark retrieved - there may be no other waiters
+            raise
+        else:
+            future.set_result(value)
+            if self._recent is not None:
+                self._recent.set(key, value)
+            return value
+        finally:
+            self._inflight.pop(key, None)
+
+
+class TokenBucketLimiter:
+    """
+    Per-key token buckets: a key holds up to `capacity` tokens and regains
+    `refill_per_second` of them each second. A key idle long enough to refill
+    is forgotten (that is the same as a full bucket), so memory stays bounded
+    by `maxsize` recently active keys.
+    """
+
+    def __init__(self, capacity: float, refill_per_second: float, maxsize: int = 100_000):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self._buckets = TTLCache(maxsize=maxsize, ttl=capacity / refill_per_second)
+        self._lock = threading.Lock()
+
+    def try_acquire(self, key: Hashable, tokens: float = 1) -> bool:
+        """Take `tokens` from the key's bucket; False (nothing taken) if it has too few."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._buckets.get(key)
+            if entry is None:
+                available = self.capacity
+            else:
+                updated_at, level = entry
+                available = min(self.capacity, level + (now - updated_at) * self.refill_per_second)
+            if tokens > available:
+                self._buckets.set(key, (now, available))
+                return False
+            self._buckets.set(key, (now, available - tokens))
+            return True
+
+
+# ─── Dataset caches ──────────────────────────────────────────────
+# /ai/generate re-reads the same dataset rows and image lists on every call.
+# Anything that writes a dataset or its images calls invalidate_dataset(), which
+# only reaches this worker: the TTL bounds how long other workers lag behind
+# (an upload made through one worker shows up in generation everywhere within it).
+DATASET_CACHE_TTL_SECONDS = 15
+
+dataset_cache = TTLCache(maxsize=1024, ttl=DATASET_CACHE_TTL_SECONDS)
+dataset_images_cache = TTLCache(maxsize=256, ttl=DATASET_CACHE_TTL_SECONDS)
+
+
+def invalidate_dataset(dataset_id: str) -> None:
+    dataset_cache.pop(dataset_id)
+    dataset_images_cache.pop(dataset_id)
+
+
+# Folder listing (datasets with their environment names) that /ai/generate
+# scans to resolve @mentions, keyed by user id; None is the unscoped listing
+# used for anonymous callers. Anything that creates, renames or deletes a
+# folder or environment calls invalidate_dataset_listing(); other workers pick
+# the change up within DATASET_CACHE_TTL_SECONDS.
+dataset_listing_cache = TTLCache(maxsize=10_000, ttl=DATASET_CACHE_TTL_SECONDS)
+
+
+def invalidate_dataset_listing(user_id: str | None) -> None:
+    dataset_listing_cache.pop(user_id)
+    dataset_listing_cache.pop(None)
@@ -1,51 +1,128 @@
 import os
-from dotenv import load_dotenv
+from dataclasses import dataclass
+from app.envcompile import load_env
 
-# Load environment variables from .env file
-load_dotenv()
+# Bind the environ mapping once; every lookup below is a plain dict get
+_env = os.environ
+
+# Load environment variables from the .env file (via its compiled cache).
+# Like load_dotenv(), values already set in the real environment win.
+for _key, _value in load_env().items():
+    _env.setdefault(_key, _value)
 
 # Supabase configuration
 # IMPORTANT: Using PRODUCTION environment to match frontend/mobile apps
-SUPABASE_URL = os.getenv("SUPABASE_URL")  # PROD: https://qxripdllxckfpnimzxoa.supabase.co
-SUPABASE_URL_DEV = os.getenv("SUPABASE_URL_DEV")  # DEV: https://fxrygwdyysakwsfcjjts.supabase.co
+SUPABASE_URL = _env.get("SUPABASE_URL")  # PROD: https://qxripdllxckfpnimzxoa.supabase.co
+SUPABASE_URL_DEV = _env.get("SUPABASE_URL_DEV")  # DEV: https://fxrygwdyysakwsfcjjts.supabase.co
 
 # Anon key for client operations (JWT format - this is what Supabase client expects)
-SUPABASE_ANON_KEY = os.getenv("SUPABASE_ANON_KEY")  # PROD anon key
-SUPABASE_ANON_KEY_DEV = os.getenv("SUPABSE_DEV_KEY")  # DEV anon key
+SUPABASE_ANON_KEY = _env.get("SUPABASE_ANON_KEY")  # PROD anon key
+SUPABASE_ANON_KEY_DEV = _env.get("SUPABSE_DEV_KEY")  # DEV anon key
 
 # Service key for backend operations
 # The sbp_ format is for server-side SDKs, not the Python client which expects JWT tokens
-SUPABASE_SERVICE_KEY = os.getenv("SUPABASE_SERVICE_KEY")  # sbp_ format (not used)
+SUPABASE_SERVICE_KEY = _env.get("SUPABASE_SERVICE_KEY")  # sbp_ format (not used)
 
 # Service Role Key (JWT format) - for DEV environment only
 # NOTE: We don't have a PROD service role key in .env, so we'll use anon key for PROD
-SUPABASE_SERVICE_ROLE_KEY_DEV = os.getenv("SUPABASE_SERVICE_ROLE_KEY")  # DEV service role
+SUPABASE_SERVICE_ROLE_KEY_DEV = _env.get("SUPABASE_SERVICE_ROLE_KEY")  # DEV service role
+SUPABASE_SERVICE_ROLE_KEY_PROD = _env.get("SUPABASE_SERVICE_ROLE_KEY_PROD")  # PROD service role, if set
 
 # IMPORTANT: The Supabase Python client requires a JWT token
 # For PROD: Using anon key (RLS is disabled on tables, so anon key has full access)
 # For DEV: Could use service role key, but we're on PROD
 SUPABASE_KEY = SUPABASE_ANON_KEY  # Use PROD anon key
-SUPABASE_SERVICE_ROLE_KEY = SUPABASE_ANON_KEY  # Use anon key as "service role" for PROD
+# Use anon key as "service role" for PROD until SUPABASE_SERVICE_ROLE_KEY_PROD is set.
+# The SQL functions from the setup_*.sql scripts are only executable by the real
+# service role; with the anon key the API falls back to the per-table queries.
+SUPABASE_SERVICE_ROLE_KEY = SUPABASE_SERVICE_ROLE_KEY_PROD or SUPABASE_ANON_KEY
+
+# JWT secret (Project Settings > API) - lets us verify access tokens locally
+# instead of calling /auth/v1/user on every request. Optional.
+SUPABASE_JWT_SECRET = _env.get("SUPABASE_JWT_SECRET")
 
-# Database settings
-DB_POOL_SIZE = 5
+# Database settings - the pooled HTTP session behind both Supabase clients
+# (app/dependencies.py). Keep DB_POOL_SIZE x workers under the project's
+# connection limit.
+DB_POOL_SIZE = int(_env.get("DB_POOL_SIZE", "60"))  # Max open connections per worker
+DB_MAX_KEEPALIVE = int(_env.get("DB_MAX_KEEPALIVE", "40"))  # Idle connections kept for reuse
+DB_KEEPALIVE_EXPIRY = float(_env.get("DB_KEEPALIVE_EXPIRY", "60"))  # Seconds before an idle connection is dropped
+DB_CONNECT_RETRIES = int(_env.get("DB_CONNECT_RETRIES", "3"))  # Retries for failed connection attempts
 DB_TIMEOUT = 30 
 
-GCP_PROJECT_ID=os.getenv("GCP_PROJECT_ID")
-GCS_BUCKET_NAME=os.getenv("GCS_BUCKET_NAME")
-GCP_CLIENT_EMAIL=os.getenv("GCP_CLIENT_EMAIL")
-GCP_PRIVATE_KEY=os.getenv("GCP_PRIVATE_KEY")
+GCP_PROJECT_ID=_env.get("GCP_PROJECT_ID")
+GCS_BUCKET_NAME=_env.get("GCS_BUCKET_NAME")
+GCP_CLIENT_EMAIL=_env.get("GCP_CLIENT_EMAIL")
+GCP_PRIVATE_KEY=_env.get("GCP_PRIVATE_KEY")
 
 # Stripe configuration
-STRIPE_SECRET_KEY = os.getenv("STRIPE_SECRET_KEY")
-STRIPE_PUBLISHABLE_KEY = os.getenv("STRIPE_PUBLISHABLE_KEY")
-STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")
-STRIPE_TEST_SECRET_KEY = os.getenv("STRIPE_TEST_SECRET_KEY")
-STRIPE_TEST_PUBLISHABLE_KEY = os.getenv("STRIPE_TEST_PUBLISHABLE_KEY")
-STRIPE_TEST_WEBHOOK_SECRET = os.getenv("STRIPE_TEST_WEBHOOK_SECRET")
+STRIPE_SECRET_KEY = _env.get("STRIPE_SECRET_KEY")
+STRIPE_PUBLISHABLE_KEY = _env.get("STRIPE_PUBLISHABLE_KEY")
+STRIPE_WEBHOOK_SECRET = _env.get("STRIPE_WEBHOOK_SECRET")
+STRIPE_TEST_SECRET_KEY = _env.get("STRIPE_TEST_SECRET_KEY")
+STRIPE_TEST_PUBLISHABLE_KEY = _env.get("STRIPE_TEST_PUBLISHABLE_KEY")
+STRIPE_TEST_WEBHOOK_SECRET = _env.get("STRIPE_TEST_WEBHOOK_SECRET")
 STRIPE_API_VERSION = "2019-09-09"
-STRIPE_APPLE_PAY_MERCHANT_ID = os.getenv("STRIPE_APPLE_PAY_MERCHANT_ID")
-STRIPE_GOOGLE_PAY_MERCHANT_ID = os.getenv("STRIPE_GOOGLE_PAY_MERCHANT_ID")
+STRIPE_APPLE_PAY_MERCHANT_ID = _env.get("STRIPE_APPLE_PAY_MERCHANT_ID")
+STRIPE_GOOGLE_PAY_MERCHANT_ID = _env.get("STRIPE_GOOGLE_PAY_MERCHANT_ID")
+
+# Logging level for the app's loggers (DEBUG, INFO, WARNING, ...)
+LOG_LEVEL = _env.get("LOG_LEVEL", "INFO").upper()
+
+# CORS: comma-separated list of frontend origins, e.g.
+# ALLOWED_ORIGINS=https://app.example.com,http://localhost:3000
+# Empty means any origin, without credentials.
+ALLOWED_ORIGINS = tuple(origin.strip() for origin in _env.get("ALLOWED_ORIGINS", "").split(",") if origin.strip())
+
+GOOGLE_API_KEY = _env.get("GOOGLE_API_KEY")
+# Concurrent Gemini calls per /ai/dataset/analyze-fast request; raise it if the
+# Gemini quota allows
+GEMINI_CONCURRENCY = int(_env.get("GEMINI_CONCURRENCY", "20"))
+TOMTOM_API_KEY = _env.get("TOMTOM_API_KEY")
+
+
+@dataclass(frozen=True, slots=True)
+class Settings:
+    """Immutable snapshot of the configuration values above."""
+    SUPABASE_URL: str | None
+    SUPABASE_URL_DEV: str | None
+    SUPABASE_ANON_KEY: str | None
+    SUPABASE_ANON_KEY_DEV: str | None
+    SUPABASE_SERVICE_KEY: str | None
+    SUPABASE_SERVICE_ROLE_KEY_DEV: str | None
+    SUPABASE_SERVICE_ROLE_KEY_PROD: str | None
+    SUPABASE_KEY: str | None
+    SUPABASE_SERVICE_ROLE_KEY: str | None
+    SUPABASE_JWT_SECRET: str | None
+    DB_POOL_SIZE: int
+    DB_MAX_KEEPALIVE: int
+    DB_KEEPALIVE_EXPIRY: float
+    DB_CONNECT_RETRIES: int
+    DB_TIMEOUT: int
+    GCP_PROJECT_ID: str | None
+    GCS_BUCKET_NAME: str | None
+    GCP_CLIENT_EMAIL: str | None
+    GCP_PRIVATE_KEY: str | None
+    STRIPE_SECRET_KEY: str | None
+    STRIPE_PUBLISHABLE_KEY: str | None
+    STRIPE_WEBHOOK_SECRET: str | None
+    STRIPE_TEST_SECRET_KEY: str | None
+    STRIPE_TEST_PUBLISHABLE_KEY: str | None
+    STRIPE_TEST_WEBHOOK_SECRET: str | None
+    STRIPE_API_VERSION: str
+    STRIPE_APPLE_PAY_MERCHANT_ID: str | None
+    STRIPE_GOOGLE_PAY_MERCHANT_ID: str | None
+    LOG_LEVEL: str
+    ALLOWED_ORIGINS: tuple[str, ...]
+    GOOGLE_API_KEY: str | None
+    GEMINI_CONCURRENCY: int
+    TOMTOM_API_KEY: str | None
+
+
+# The one Settings instance; import this rather than the module-level names
+settings = Settings(**{name: globals()[name] for name in Settings.__dataclass_fields__})
+
 
-GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-TOMTOM_API_KEY = os.getenv("TOMTOM_API_KEY")
+def get_settings() -> Settings:
+    """Return the shared Settings instance."""
+    return settings
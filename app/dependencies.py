@@ -1,12 +1,51 @@
+import asyncio
+import base64
+import hashlib
+import time
+from dataclasses import dataclass
+from typing import Any
+import httpx
+import jwt
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from supabase import create_client, Client
-from app.config import SUPABASE_URL, SUPABASE_KEY, SUPABASE_SERVICE_ROLE_KEY
+from supabase.lib.client_options import SyncClientOptions
+from supabase_auth.errors import AuthApiError
+from app.cache import TTLCache
+from app.config import settings
+
+# One pooled HTTP session shared by both Supabase clients (PostgREST, Storage
+# and Auth). Keep-alive connections are reused across requests instead of each
+# sub-client owning its own pool and redoing TCP/TLS handshakes.
+# Auth headers are sent per request, so sharing the session between the
+# anon and admin clients is safe. Closed in the app lifespan (app/main.py).
+# The pool is bounded (DB_POOL_SIZE) so a burst of threadpool queries queues
+# for a connection instead of opening more than the project allows, and idle
+# connections are dropped before the server side times them out. Failed
+# connection attempts are retried by the transport; requests that reached the
+# server are not, so inserts and credit deductions never run twice.
+http_session = httpx.Client(
+    timeout=settings.DB_TIMEOUT,
+    transport=httpx.HTTPTransport(
+        http2=True,
+        limits=httpx.Limits(
+            max_connections=settings.DB_POOL_SIZE,
+            max_keepalive_connections=settings.DB_MAX_KEEPALIVE,
+            keepalive_expiry=settings.DB_KEEPALIVE_EXPIRY,
+        ),
+        retries=settings.DB_CONNECT_RETRIES,
+    ),
+    follow_redirects=True,
+)
 
 # Initialize Supabase client
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+supabase: Client = create_client(settings.SUPABASE_URL, settings.SUPABASE_KEY, options=SyncClientOptions(httpx_client=http_session))
 # Initialize Admin Supabase client (Service Role)
-supabase_admin: Client = create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
+supabase_admin: Client = create_client(settings.SUPABASE_URL, settings.SUPABASE_SERVICE_ROLE_KEY, options=SyncClientOptions(httpx_client=http_session))
+# The admin client always authenticates with the same key, so build its
+# PostgREST sub-client now with the bearer header bound once, rather than
+# lazily on the first admin query.
+supabase_admin.postgrest.auth(settings.SUPABASE_SERVICE_ROLE_KEY)
 
 def get_supabase() -> Client:
     return supabase
@@ -14,29 +53,252 @@ def get_supabase() -> Client:
 def get_supabase_admin() -> Client:
     return supabase_admin
 
+def close_http_clients() -> None:
+    http_session.close()
+
+# Shared async client for Supabase Storage traffic from async endpoints:
+# downloads (reference/dataset images) and direct object uploads. HTTP/2 lets
+# concurrent requests multiplex over a few pooled connections. Closed in the
+# app lifespan via aclose_http_clients().
+async_http_client = httpx.AsyncClient(
+    timeout=10,
+    limits=httpx.Limits(max_keepalive_connections=50, max_connections=100),
+    follow_redirects=True,
+    http2=True,
+)
+
+async def aclose_http_clients() -> None:
+    close_http_clients()
+    await async_http_client.aclose()
+
+async def execute_async(query):
+    """Run a supabase-py query builder's blocking .execute() off the event loop."""
+    return await asyncio.to_thread(query.execute)
+
+def public_object_url(bucket: str, path: str) -> str:
+    """Public URL of a Storage object - the same template get_public_url() formats, without the bucket proxy."""
+    return f"{settings.SUPABASE_URL.rstrip('/')}/storage/v1/object/public/{bucket}/{path}"
+
+def encode_keyset_cursor(row: dict) -> str:
+    """Opaque keyset cursor for newest-first history lists: the last row's (created_at, id)."""
+    return base64.urlsafe_b64encode(f"{row['created_at']}|{row['id']}".encode()).decode()
+
+def decode_keyset_cursor(cursor: str) -> tuple[str, str]:
+    """(created_at, id) from encode_keyset_cursor; 400 if the cursor is malformed."""
+    try:
+        created_at, row_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|", 1)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return created_at, row_id
+
+def keyset_page(query, limit: int, offset: int, position: tuple[str, str] | None):
+    """
+    Newest-first page of a PostgREST query; id breaks ties between equal timestamps.
+    With a decoded cursor it seeks past the previous page's last row, so deep
+    pages cost the same as the first; without one it falls back to offset.
+    """
+    query = query.order("created_at", desc=True).order("id", desc=True)
+    if position is None:
+        return query.range(offset, offset + limit - 1)
+    created_at, row_id = position
+    return query.or_(
+        f'created_at.lt."{created_at}",and(created_at.eq."{created_at}",id.lt."{row_id}")'
+    ).limit(limit)
+
+async def upload_storage_object(bucket: str, path: str, data: bytes, content_type: str) -> None:
+    """
+    Upload an object with the service key straight to the Storage REST API
+    over the shared async pool (what the bucket client's upload() does, without
+    a worker thread). Raises httpx.HTTPStatusError if Storage rejects it.
+    """
+    key = settings.SUPABASE_SERVICE_ROLE_KEY
+    response = await async_http_client.post(
+        f"{settings.SUPABASE_URL.rstrip('/')}/storage/v1/object/{bucket}/{path}",
+        content=data,
+        headers={
+            "Authorization": f"Bearer {key}",
+            "apikey": key,
+            "Content-Type": content_type,
+            "x-upsert": "false",
+        },
+        timeout=settings.DB_TIMEOUT,
+    )
+    response.raise_for_status()
+
 security = HTTPBearer()
 security_optional = HTTPBearer(auto_error=False)
 
-def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security), client: Client = Depends(get_supabase)):
+@dataclass(frozen=True, slots=True)
+class AuthenticatedUser:
+    """
+    The verified caller, as handed to endpoints by get_current_user.
+    Carries the id pre-formatted as a string (id_str) so handlers don't
+    rebuild it on every query.
+    """
+    id: Any
+    id_str: str
+    email: str | None = None
+    app_metadata: dict | None = None
+    user_metadata: dict | None = None
+    created_at: Any = None
+    last_sign_in_at: Any = None
+
+    @classmethod
+    def from_supabase(cls, user) -> "AuthenticatedUser":
+        return cls(
+            id=user.id,
+            id_str=str(user.id),
+            email=user.email,
+            app_metadata=user.app_metadata,
+            user_metadata=user.user_metadata,
+            created_at=user.created_at,
+            last_sign_in_at=user.last_sign_in_at,
+        )
+
+    @classmethod
+    def from_claims(cls, claims: dict) -> "AuthenticatedUser":
+        # Access tokens don't carry created_at / last_sign_in_at
+        return cls(
+            id=claims["sub"],
+            id_str=claims["sub"],
+            email=claims.get("email"),
+            app_metadata=claims.get("app_metadata"),
+            user_metadata=claims.get("user_metadata"),
+        )
+
+
+# ─── Token verification cache ────────────────────────────────────
+# Verified users are cached per token so repeat requests skip the
+# round-trip to Supabase's /auth/v1/user. Keys are a hash of the token,
+# never the raw token, and entries never outlive the token's own exp.
+AUTH_CACHE_TTL_SECONDS = 60
+AUTH_CACHE_MAX_ENTRIES = 10_000
+
+_verified_user_cache = TTLCache(maxsize=AUTH_CACHE_MAX_ENTRIES, ttl=AUTH_CACHE_TTL_SECONDS)
+
+
+def _token_cache_key(token: str) -> bytes:
+    return hashlib.blake2b(token.encode(), digest_size=16).digest()
+
+
+def _token_expiry(token: str) -> float | None:
+    """Read the exp claim without verifying the signature (Supabase still verifies it)."""
+    try:
+        claims = jwt.decode(token, options={"verify_signature": False})
+    except jwt.PyJWTError:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
+    exp = claims.get("exp")
+    if exp is not None and exp <= time.time():
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token has expired")
+    return exp
+
+
+# ─── Local JWT verification ──────────────────────────────────────
+# With SUPABASE_JWT_SECRET set, access tokens are verified in-process
+# (HS256 signature, exp and audience) with no network call. Supabase is
+# still asked about each token at most once per AUTH_REVALIDATE_SECONDS,
+# in the background, so tokens revoked by sign-out stop working shortly after.
+# Tokens the secret can't verify (e.g. signed with an asymmetric key) go
+# through the regular Supabase lookup instead.
+AUTH_REVALIDATE_SECONDS = 300
+
+_revalidated_tokens = TTLCache(maxsize=AUTH_CACHE_MAX_ENTRIES, ttl=AUTH_REVALIDATE_SECONDS)
+_revoked_tokens = TTLCache(maxsize=AUTH_CACHE_MAX_ENTRIES, ttl=3600)
+_background_tasks: set[asyncio.Task] = set()
+
+
+async def _revalidate_token(token: str, cache_key: bytes, exp: float | None, client: Client) -> None:
+    try:
+        response = await asyncio.to_thread(client.auth.get_user, token)
+        revoked = not response or not response.user
+    except AuthApiError as e:
+        if e.status not in (401, 403):
+            # Throttled (429) or failing (5xx) - not a verdict on the token;
+            # keep trusting the signature, retry next window
+            _revalidated_tokens.pop(cache_key)
+            return
+        revoked = True
+    except Exception:
+        # Supabase unreachable - keep trusting the signature, retry next window
+        _revalidated_tokens.pop(cache_key)
+        return
+    if revoked:
+        ttl = 3600 if exp is None else exp - time.time()
+        if ttl > 0:
+            _revoked_tokens.set(cache_key, True, ttl=ttl)
+
+
+def _verify_token_locally(token: str, client: Client) -> AuthenticatedUser | None:
+    """
+    The user for a token verified with SUPABASE_JWT_SECRET, or None when the
+    secret can't decide (the caller then asks Supabase). Expired and revoked
+    tokens are rejected outright.
+    """
+    try:
+        claims = jwt.decode(token, settings.SUPABASE_JWT_SECRET, algorithms=["HS256"], audience="authenticated")
+    except jwt.ExpiredSignatureError:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token has expired")
+    except jwt.PyJWTError:
+        return None
+    if "sub" not in claims:
+        return None
+
+    cache_key = _token_cache_key(token)
+    if _revoked_tokens.get(cache_key):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token has been revoked")
+    if _revalidated_tokens.get(cache_key) is None:
+        _revalidated_tokens.set(cache_key, True)
+        task = asyncio.create_task(_revalidate_token(token, cache_key, claims.get("exp"), client))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+
+    return AuthenticatedUser.from_claims(claims)
+
+
+async def _verify_token(token: str, client: Client):
+    """Return the AuthenticatedUser for a token, from cache when possible. None if invalid."""
+    if settings.SUPABASE_JWT_SECRET:
+        user = _verify_token_locally(token, client)
+        if user is not None:
+            return user
+
+    exp = _token_expiry(token)
+    cache_key = _token_cache_key(token)
+    user = _verified_user_cache.get(cache_key)
+    if user is not None:
+        return user
+
+    # get_user is a blocking HTTPS call - keep it off the event loop
+    response = await asyncio.to_thread(client.auth.get_user, token)
+    if not response or not response.user:
+        return None
+
+    user = AuthenticatedUser.from_supabase(response.user)
+    ttl = AUTH_CACHE_TTL_SECONDS
+    if exp is not None:
+        ttl = min(ttl, exp - time.time())
+    if ttl > 0:
+        _verified_user_cache.set(cache_key, user, ttl=ttl)
+    return user
+
+
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security), client: Client = Depends(get_supabase)):
     token = credentials.credentials
     try:
         # Verify the token using Supabase
         # get_user returns the user object if the token is valid
-        response = client.auth.get_user(token)
-        if not response or not response.user:
+        user = await _verify_token(token, client)
+        if not user:
              raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
-        return response.user
+        return user
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=f"Could not validate credentials: {str(e)}")
 
-def get_current_user_optional(credentials: HTTPAuthorizationCredentials = Depends(security_optional), client: Client = Depends(get_supabase)):
+async def get_current_user_optional(credentials: HTTPAuthorizationCredentials = Depends(security_optional), client: Client = Depends(get_supabase)):
     if not credentials:
         return None
     token = credentials.credentials
     try:
-        response = client.auth.get_user(token)
-        if not response or not response.user:
-             return None
-        return response.user
+        return await _verify_token(token, client)
     except Exception:
         return None
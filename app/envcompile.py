@@ -0,0 +1,70 @@
+"""
+Compile the project's .env file into an importable Python module.
+
+Parsing .env with python-dotenv on every worker start costs file I/O plus
+tokenization. Instead we parse it once, write the result to
+app/_env_compiled.py as a plain dict literal, and let later imports come
+straight from the cached bytecode. The compiled module is rebuilt whenever
+.env is newer than it.
+"""
+import importlib
+import os
+import tempfile
+from pathlib import Path
+
+from dotenv import dotenv_values
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+DEFAULT_ENV_PATH = PROJECT_ROOT / ".env"
+COMPILED_ENV_PATH = Path(__file__).resolve().parent / "_env_compiled.py"
+COMPILED_ENV_MODULE = "app._env_compiled"
+
+
+def compile_env(path: str | os.PathLike = DEFAULT_ENV_PATH, target: str | os.PathLike = COMPILED_ENV_PATH) -> dict[str, str]:
+    """Parse the .env file once and atomically write it out as `ENV = {...}`."""
+    env = {key: value for key, value in dotenv_values(path).items() if value is not None}
+
+    target = Path(target)
+    source = (
+        "# Generated by app/envcompile.py from .env - do not edit or commit.\n"
+        f"ENV = {env!r}\n"
+    )
+    # Write to a temp file in the same directory, then rename over the target,
+    # so a concurrently starting worker never imports a half-written module.
+    fd, tmp_path = tempfile.mkstemp(dir=target.parent, prefix=".env_compiled_", suffix=".py")
+    try:
+        with os.fdopen(fd, "w") as fh:
+            fh.write(source)
+        os.replace(tmp_path, target)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    importlib.invalidate_caches()
+    return env
+
+
+def load_env(path: str | os.PathLike = DEFAULT_ENV_PATH) -> dict[str, str]:
+    """
+    Return the key/value pairs from .env, using the compiled module when it is fresh.
+    Returns an empty dict when there is no .env file (e.g. env vars come from the host).
+    """
+    path = Path(path)
+    if not path.exists():
+        return {}
+
+    compiled_fresh = (
+        COMPILED_ENV_PATH.exists()
+        and COMPILED_ENV_PATH.stat().st_mtime >= path.stat().st_mtime
+    )
+    if compiled_fresh:
+        try:
+            return dict(importlib.import_module(COMPILED_ENV_MODULE).ENV)
+        except Exception:
+            pass  # Corrupt or unreadable cache - rebuild it below
+
+    try:
+        return compile_env(path)
+    except OSError:
+        # Read-only filesystem: still honour .env, just without the cache
+        return {key: value for key, value in dotenv_values(path).items() if value is not None}
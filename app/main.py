@@ -1,26 +1,102 @@
+import importlib
+import logging
+import threading
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from app.routers import auth, users, storage, business, ai, account, environments
+from app.config import settings
+from app.dependencies import aclose_http_clients
 
-app = FastAPI(title="AI Picture APIs")
+# Route the app's module loggers (logging.getLogger(__name__)) to stderr.
+# uvicorn configures only its own loggers, so without this they'd be dropped below WARNING.
+logging.basicConfig(format="%(levelname)s:     %(name)s - %(message)s")
+logging.getLogger("app").setLevel(settings.LOG_LEVEL)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # Release the pooled connections shared by the Supabase and download clients
+    await aclose_http_clients()
+
+
+app = FastAPI(title="AI Picture APIs", lifespan=lifespan)
 
 # Configure CORS
-# Explicitly allow OPTIONS and all methods/headers to fix 405 errors and pre-flight issues
+# Explicitly allow OPTIONS and all methods/headers to fix 405 errors and pre-flight issues.
+# Credentials are only allowed for an explicit ALLOWED_ORIGINS list; the "*" fallback
+# (development) goes without them, as the CORS spec requires.
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # Allow all origins for now (development)
-    allow_credentials=True,
+    allow_origins=list(settings.ALLOWED_ORIGINS) or ["*"],
+    allow_credentials=bool(settings.ALLOWED_ORIGINS),
     allow_methods=["*"],  # Allows all methods including OPTIONS
     allow_headers=["*"],  # Allows all headers
+    expose_headers=["X-Next-Cursor"],  # History pagination cursor (app/routers/account.py)
+    max_age=86400,  # Let browsers cache preflight responses for a day
 )
 
-app.include_router(auth.router)
-app.include_router(users.router)
-app.include_router(storage.router)
-app.include_router(business.router)
-app.include_router(ai.router)
-app.include_router(account.router)
-app.include_router(environments.router)
+# ─── Lazy router loading ─────────────────────────────────────────
+# Routers are imported on the first request that hits their path prefix, so
+# heavy dependencies (google-genai, Pillow in the AI router) stay off the
+# cold-start path of every worker.
+LAZY_ROUTERS = {
+    "/auth": "app.routers.auth",
+    "/users": "app.routers.users",
+    "/storage": "app.routers.storage",
+    "/business": "app.routers.business",
+    "/ai": "app.routers.ai",
+    "/account": "app.routers.account",
+    "/environments": "app.routers.environments",
+    "/folders": "app.routers.environments",
+}
+
+_loaded_router_modules: set[str] = set()
+_router_lock = threading.Lock()
+
+
+def _include_router_module(module_name: str) -> None:
+    if module_name in _loaded_router_modules:
+        return
+    with _router_lock:
+        if module_name in _loaded_router_modules:
+            return
+        module = importlib.import_module(module_name)
+        app.include_router(module.router)
+        _loaded_router_modules.add(module_name)
+        # New routes must show up in the generated OpenAPI schema
+        app.openapi_schema = None
+
+
+def include_all_routers() -> None:
+    """Eagerly import every router (used for the docs/OpenAPI pages)."""
+    for module_name in dict.fromkeys(LAZY_ROUTERS.values()):
+        _include_router_module(module_name)
+
+
+def _load_routers_for_path(path: str) -> None:
+    if path in (app.openapi_url, app.docs_url, app.redoc_url):
+        include_all_routers()
+        return
+    for prefix, module_name in LAZY_ROUTERS.items():
+        if path == prefix or path.startswith(prefix + "/"):
+            _include_router_module(module_name)
+            return
+
+
+class LazyRouterMiddleware:
+    """Plain ASGI middleware that mounts a router before its first request is routed."""
+
+    def __init__(self, asgi_app):
+        self.app = asgi_app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            _load_routers_for_path(scope["path"])
+        await self.app(scope, receive, send)
+
+
+app.add_middleware(LazyRouterMiddleware)
 
 @app.get("/")
 def root():
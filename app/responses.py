@@ -0,0 +1,21 @@
+"""
+Response classes shared by the routers.
+"""
+from typing import Any
+
+import orjson
+from fastapi.responses import JSONResponse
+
+
+class ORJSONResponse(JSONResponse):
+    """
+    JSONResponse rendered with orjson.
+
+    Only used on routers whose endpoints return plain dicts without a
+    response_model. Endpoints that declare a response_model already have
+    FastAPI dump them straight to JSON bytes via pydantic-core, and setting a
+    custom response class on them would turn that fast path off.
+    """
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
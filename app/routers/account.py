@@ -1,6 +1,14 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Query
+import asyncio
+import logging
+from pydantic import BaseModel
+from fastapi import APIRouter, Depends, HTTPException, status, Query, Response
 from supabase import Client
-from app.dependencies import get_current_user, get_supabase
+from postgrest.exceptions import APIError as PostgrestAPIError
+from app.cache import SingleFlight, StaleWhileRevalidateCache
+from app.dependencies import (
+    get_current_user, get_supabase, get_supabase_admin, execute_async,
+    encode_keyset_cursor, decode_keyset_cursor, keyset_page
+)
 from app.schemas import (
     UserProfileUpdate, UserProfileResponse,
     SubscriptionResponse, PlanResponse,
@@ -8,39 +16,67 @@ from app.schemas import (
     UsageLogResponse, AccountSummaryResponse
 )
 
+logger = logging.getLogger(__name__)
+
 router = APIRouter(prefix="/account", tags=["Account"])
 
+# Plans change only when pricing changes, so they are served stale-while-revalidate:
+# a cached copy is returned right away and refreshed in the background once it is
+# older than `ttl`. Profiles aren't cached - each worker would keep its own copy, and
+# a GET served by another worker than the PUT must still see the update.
+_plans_cache = StaleWhileRevalidateCache(maxsize=1, ttl=300, stale_ttl=3600)
+# Concurrent or back-to-back (50 ms) dashboard polls for the same user share one summary fetch
+_summary_flight = SingleFlight(linger=0.05)
+# Set once account_summary turns out not to exist or not to be executable by our
+# key (setup_account_summary.sql)
+_account_summary_missing = False
+
+def _cols(model: type[BaseModel], *exclude: str) -> str:
+    """PostgREST select list naming exactly the fields of a response model."""
+    return ",".join(f for f in model.model_fields if f not in exclude)
+
+
+# Select lists are built once at import time and reused by every request
+PROFILE_COLUMNS = _cols(UserProfileResponse)
+PLAN_COLUMNS = _cols(PlanResponse)
+CREDIT_BALANCE_COLUMNS = _cols(CreditBalanceResponse)
+CREDIT_TRANSACTION_COLUMNS = _cols(CreditTransactionResponse)
+USAGE_LOG_COLUMNS = _cols(UsageLogResponse)
+# The nested plan comes from the plans(...) embed and is renamed to "plan" afterwards
+SUBSCRIPTION_COLUMNS = f"{_cols(SubscriptionResponse, 'plan')},plans({PLAN_COLUMNS})"
+
 
 # ─── Profile ─────────────────────────────────────────────────────
 
 @router.get("/profile", response_model=UserProfileResponse)
-def get_profile(
+async def get_profile(
     current_user=Depends(get_current_user),
     supabase: Client = Depends(get_supabase)
 ):
     """Get the current user's profile (first name, last name, creative type, etc.)."""
+    user_id = current_user.id_str
     try:
-        res = supabase.table("user_profiles").select("*").eq("id", str(current_user.id)).execute()
+        res = await execute_async(supabase.table("user_profiles").select(PROFILE_COLUMNS).eq("id", user_id))
         if not res.data:
             # Profile doesn't exist yet — return empty shell
-            return UserProfileResponse(id=str(current_user.id))
+            return UserProfileResponse(id=user_id)
         return res.data[0]
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 
 @router.put("/profile", response_model=UserProfileResponse)
-def update_profile(
+async def update_profile(
     profile: UserProfileUpdate,
     current_user=Depends(get_current_user),
     supabase: Client = Depends(get_supabase)
 ):
     """Create or update the current user's profile."""
     try:
-        data = profile.dict(exclude_unset=True)
-        data["id"] = str(current_user.id)
-        res = supabase.table("user_profiles").upsert(data).execute()
-        return res.data[0]
+        data = profile.model_dump(exclude_unset=True, mode="json")
+        data["id"] = current_user.id_str
+        res = await execute_async(supabase.table("user_profiles").upsert(data))
+        return UserProfileResponse.model_validate(res.data[0])
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
@@ -48,16 +84,17 @@ def update_profile(
 # ─── Subscription ────────────────────────────────────────────────
 
 @router.get("/subscription", response_model=SubscriptionResponse)
-def get_subscription(
+async def get_subscription(
     current_user=Depends(get_current_user),
     supabase: Client = Depends(get_supabase)
 ):
     """Get the current user's subscription with plan details."""
     try:
-        res = supabase.table("subscriptions") \
-            .select("*, plans(*)") \
-            .eq("user_id", str(current_user.id)) \
-            .execute()
+        res = await execute_async(
+            supabase.table("subscriptions")
+            .select(SUBSCRIPTION_COLUMNS)
+            .eq("user_id", current_user.id_str)
+        )
         if not res.data:
             raise HTTPException(status_code=404, detail="No subscription found")
         row = res.data[0]
@@ -74,16 +111,17 @@ def get_subscription(
 # ─── Credits ─────────────────────────────────────────────────────
 
 @router.get("/credits", response_model=CreditBalanceResponse)
-def get_credits(
+async def get_credits(
     current_user=Depends(get_current_user),
     supabase: Client = Depends(get_supabase)
 ):
     """Get the current user's credit balance (total, used, remaining)."""
     try:
-        res = supabase.table("credit_balances") \
-            .select("*") \
-            .eq("user_id", str(current_user.id)) \
-            .execute()
+        res = await execute_async(
+            supabase.table("credit_balances")
+            .select(CREDIT_BALANCE_COLUMNS)
+            .eq("user_id", current_user.id_str)
+        )
         if not res.data:
             raise HTTPException(status_code=404, detail="No credit balance found")
         return res.data[0]
@@ -93,22 +131,38 @@ def get_credits(
         raise HTTPException(status_code=400, detail=str(e))
 
 
+async def _history_page(query, response: Response, limit: int, offset: int, cursor: str | None) -> list:
+    """
+    One newest-first page of a per-user history table. A full page sets the
+    X-Next-Cursor header; pass it back as ?cursor= to seek past this page
+    instead of skipping rows with offset.
+    """
+    position = decode_keyset_cursor(cursor) if cursor else None
+    res = await execute_async(keyset_page(query, limit, offset, position))
+    if len(res.data) == limit:
+        response.headers["X-Next-Cursor"] = encode_keyset_cursor(res.data[-1])
+    return res.data
+
+
 @router.get("/credits/history", response_model=list[CreditTransactionResponse])
-def get_credit_history(
+async def get_credit_history(
+    response: Response,
     current_user=Depends(get_current_user),
     supabase: Client = Depends(get_supabase),
     limit: int = Query(default=20, ge=1, le=100),
-    offset: int = Query(default=0, ge=0)
+    offset: int = Query(default=0, ge=0),
+    cursor: str | None = Query(default=None, description="X-Next-Cursor of the previous page")
 ):
-    """Get paginated credit transaction history."""
+    """Get paginated credit transaction history, newest first."""
     try:
-        res = supabase.table("credit_transactions") \
-            .select("*") \
-            .eq("user_id", str(current_user.id)) \
-            .order("created_at", desc=True) \
-            .range(offset, offset + limit - 1) \
-            .execute()
-        return res.data
+        return await _history_page(
+            supabase.table("credit_transactions")
+            .select(CREDIT_TRANSACTION_COLUMNS)
+            .eq("user_id", current_user.id_str),
+            response, limit, offset, cursor
+        )
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
@@ -116,72 +170,109 @@ def get_credit_history(
 # ─── Usage ───────────────────────────────────────────────────────
 
 @router.get("/usage", response_model=list[UsageLogResponse])
-def get_usage(
+async def get_usage(
+    response: Response,
     current_user=Depends(get_current_user),
     supabase: Client = Depends(get_supabase),
     limit: int = Query(default=20, ge=1, le=100),
-    offset: int = Query(default=0, ge=0)
+    offset: int = Query(default=0, ge=0),
+    cursor: str | None = Query(default=None, description="X-Next-Cursor of the previous page")
 ):
-    """Get paginated usage logs showing every action and its credit cost."""
+    """Get paginated usage logs showing every action and its credit cost, newest first."""
     try:
-        res = supabase.table("usage_logs") \
-            .select("*") \
-            .eq("user_id", str(current_user.id)) \
-            .order("created_at", desc=True) \
-            .range(offset, offset + limit - 1) \
-            .execute()
-        return res.data
+        return await _history_page(
+            supabase.table("usage_logs")
+            .select(USAGE_LOG_COLUMNS)
+            .eq("user_id", current_user.id_str),
+            response, limit, offset, cursor
+        )
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 
 # ─── Summary (Dashboard overview) ───────────────────────────────
 
+async def _fetch_account_summary_tables(supabase: Client, user_id: str) -> dict:
+    """Fallback for get_account_summary when the account_summary SQL function is missing."""
+    # The four reads are independent — run them concurrently so the
+    # endpoint waits for the slowest one instead of the sum of all four.
+    profile_res, sub_res, credit_res, usage_res = await asyncio.gather(
+        # Profile
+        execute_async(supabase.table("user_profiles").select(PROFILE_COLUMNS).eq("id", user_id)),
+        # Subscription + plan
+        execute_async(
+            supabase.table("subscriptions")
+            .select(SUBSCRIPTION_COLUMNS)
+            .eq("user_id", user_id)
+        ),
+        # Credit balance
+        execute_async(supabase.table("credit_balances").select(CREDIT_BALANCE_COLUMNS).eq("user_id", user_id)),
+        # Recent usage (last 10)
+        execute_async(
+            supabase.table("usage_logs")
+            .select(USAGE_LOG_COLUMNS)
+            .eq("user_id", user_id)
+            .order("created_at", desc=True)
+            .limit(10)
+        ),
+    )
+
+    subscription = None
+    if sub_res.data:
+        row = sub_res.data[0]
+        plan_data = row.pop("plans", None)
+        row["plan"] = plan_data
+        subscription = row
+
+    return {
+        "profile": profile_res.data[0] if profile_res.data else None,
+        "subscription": subscription,
+        "credits": credit_res.data[0] if credit_res.data else None,
+        "recent_usage": usage_res.data,
+    }
+
+
+async def _fetch_account_summary(supabase: Client, user_id: str) -> dict:
+    """Load the summary via the account_summary SQL function, or the per-table queries."""
+    global _account_summary_missing
+    summary = None
+    if not _account_summary_missing:
+        try:
+            res = await execute_async(supabase.rpc("account_summary", {"uid": user_id}))
+            summary = res.data
+        except PostgrestAPIError as e:
+            # PGRST202: function not deployed yet; 42501: not granted to our (anon) key
+            if e.code in ("PGRST202", "42501"):
+                _account_summary_missing = True
+            else:
+                logger.warning("account_summary failed, using the per-table queries: %s", e.message)
+    if not isinstance(summary, dict):
+        summary = await _fetch_account_summary_tables(supabase, user_id)
+    return summary
+
+
 @router.get("/summary", response_model=AccountSummaryResponse)
-def get_account_summary(
+async def get_account_summary(
     current_user=Depends(get_current_user),
-    supabase: Client = Depends(get_supabase)
+    supabase: Client = Depends(get_supabase_admin)
 ):
     """
     Combined account overview for the dashboard.
     Returns profile, subscription with plan, credit balance, and recent usage.
+    Served by the account_summary SQL function (setup_account_summary.sql) in one round-trip.
+    The function reads any user's data, so it is only granted to the service role
+    and called through the admin client.
     """
-    user_id = str(current_user.id)
+    user_id = current_user.id_str
     try:
-        # Profile
-        profile_res = supabase.table("user_profiles").select("*").eq("id", user_id).execute()
-        profile = profile_res.data[0] if profile_res.data else {"id": user_id}
-
-        # Subscription + plan
-        sub_res = supabase.table("subscriptions") \
-            .select("*, plans(*)") \
-            .eq("user_id", user_id) \
-            .execute()
-        subscription = None
-        if sub_res.data:
-            row = sub_res.data[0]
-            plan_data = row.pop("plans", None)
-            row["plan"] = plan_data
-            subscription = row
-
-        # Credit balance
-        credit_res = supabase.table("credit_balances").select("*").eq("user_id", user_id).execute()
-        credits = credit_res.data[0] if credit_res.data else None
-
-        # Recent usage (last 10)
-        usage_res = supabase.table("usage_logs") \
-            .select("*") \
-            .eq("user_id", user_id) \
-            .order("created_at", desc=True) \
-            .limit(10) \
-            .execute()
-        recent_usage = usage_res.data
-
+        summary = await _summary_flight.do(user_id, lambda: _fetch_account_summary(supabase, user_id))
         return AccountSummaryResponse(
-            profile=profile,
-            subscription=subscription,
-            credits=credits,
-            recent_usage=recent_usage
+            profile=summary.get("profile") or {"id": user_id},
+            subscription=summary.get("subscription"),
+            credits=summary.get("credits"),
+            recent_usage=summary.get("recent_usage")
         )
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
@@ -190,10 +281,13 @@ def get_account_summary(
 # ─── Plans (public, no auth needed) ─────────────────────────────
 
 @router.get("/plans", response_model=list[PlanResponse])
-def list_plans(supabase: Client = Depends(get_supabase)):
+async def list_plans(supabase: Client = Depends(get_supabase)):
     """List all available plans. Public endpoint."""
-    try:
-        res = supabase.table("plans").select("*").order("price_monthly").execute()
+    async def load_plans():
+        res = await execute_async(supabase.table("plans").select(PLAN_COLUMNS).order("price_monthly"))
         return res.data
+
+    try:
+        return await _plans_cache.get_or_load("plans", load_plans)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
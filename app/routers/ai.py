@@ -1,24 +1,36 @@
 from google import genai
 from google.genai import types
 from google.genai.errors import ServerError, APIError
-from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File, Form
-from typing import List
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Request, status, UploadFile, File, Form
+from typing import List, TYPE_CHECKING, get_args
 import uuid
-import json
-import base64
-import requests
+import orjson
+import hashlib
 import re
 import difflib
 import io
-import time
 import asyncio
-import tempfile
-from PIL import Image as PILImage
-from app.schemas import GenerateImageRequest, AnalyzeImageRequest, AnalyzeDatasetRequest, UpdateDatasetTrainingStatusRequest
-from app.dependencies import get_current_user, get_current_user_optional, get_supabase, get_supabase_admin
-from app.config import GOOGLE_API_KEY
+import logging
+import httpx
+import numpy as np
+from collections import Counter
+from datetime import datetime, timezone
+from app.schemas import GenerateImageRequest, AnalyzeImageRequest, AnalyzeDatasetRequest, UpdateDatasetTrainingStatusRequest, ImageAnalysisResult, ImageStyle
+from app.cache import (
+    TTLCache, TokenBucketLimiter, dataset_cache, dataset_images_cache, dataset_listing_cache,
+    invalidate_dataset, invalidate_dataset_listing,
+)
+from app.dependencies import get_current_user, get_current_user_optional, get_supabase, get_supabase_admin, async_http_client, execute_async, public_object_url, upload_storage_object, encode_keyset_cursor, decode_keyset_cursor, keyset_page
+from app.responses import ORJSONResponse
+from app.config import settings
 from supabase import Client
-import os
+from postgrest.exceptions import APIError as PostgrestAPIError
+
+logger = logging.getLogger(__name__)
+
+if TYPE_CHECKING:
+    # Pillow is imported lazily, only when a reference image has to be prepared
+    from PIL import Image as PILImage
 
 # ─── Constants ────────────────────────────────────────────────────
 MODEL_MAX_REFERENCE_IMAGES = 14   # Gemini 3 Pro hard cap for generation inputs
@@ -26,15 +38,130 @@ REFERENCE_SELECTION_TARGET = 8    # Soft target to reduce style drift/confusion
 REFERENCE_MIN_IMAGES = 4          # Keep enough references for identity consistency
 VISION_RELEVANCE_THRESHOLD = 0.45 # Drop weakly-related vision candidates when possible
 MAX_IMAGE_DIMENSION = 1024        # Resize large images to this max width/height
+REFERENCE_JPEG_QUALITY = 85       # JPEG quality for re-encoded reference images
+# Image formats Gemini accepts as-is; anything else (GIF, BMP, TIFF...) is re-encoded
+GEMINI_IMAGE_MIME_TYPES = frozenset({"image/png", "image/jpeg", "image/webp", "image/heic", "image/heif"})
+# Formats sent as-is when small enough; PNG is lossless and usually several
+# times larger than the JPEG re-encode, so it is always re-encoded
+PASSTHROUGH_IMAGE_MIME_TYPES = GEMINI_IMAGE_MIME_TYPES - {"image/png"}
+CREDIT_UPDATE_MAX_ATTEMPTS = 5    # Compare-and-set attempts in the deduct_credits fallback
 GEMINI_MAX_RETRIES = 3            # Retry transient 500 errors up to 3 times
 GEMINI_RETRY_BASE_DELAY = 2      # Base delay in seconds (exponential backoff)
 EMBED_BATCH_SIZE = 200            # Batch embeddings for large datasets
+EMBEDDING_MODEL = "gemini-embedding-001"
+EMBEDDING_DIMENSIONS = 768        # Stored per image in dataset_images.embedding (setup_dataset_image_embeddings.sql)
+PROMPT_EMBEDDING_CACHE_MAX_ENTRIES = 2048  # Retrieval-query embeddings kept in memory (~3 KB each)
+PROMPT_EMBEDDING_CACHE_TTL_SECONDS = 24 * 3600
+IMAGE_EMBEDDING_CACHE_MAX_BYTES = 32 * 1024 * 1024  # Memory for image embeddings computed by this worker
+IMAGE_EMBEDDING_CACHE_TTL_SECONDS = 3600
 MAX_DATASET_IMAGES_FETCH = 5000   # Safety cap when scanning large datasets
 HYBRID_CANDIDATE_MULTIPLIER = 3   # Semantic prefilter pool size before vision rerank
 VISION_RERANK_BATCH_SIZE = 8      # Images per Gemini vision rerank call
 VISION_RERANK_MAX_RETRIES = 3     # Retry vision rerank batch calls
 VISION_RERANK_RETRY_BASE_DELAY = 2  # Base delay for vision rerank retry backoff
 MENTION_FUZZY_CUTOFF = 0.72       # Fuzzy threshold for mention-to-dataset matching
+ANALYZE_FAST_CONCURRENCY = settings.GEMINI_CONCURRENCY  # Parallel downloads/analyses in /dataset/analyze-fast
+MAX_UPLOAD_BYTES = 20 * 1024 * 1024  # Per-file cap for /dataset/analyze uploads
+IMAGE_GENERATION_CONCURRENCY = settings.GEMINI_CONCURRENCY  # In-flight image generations per worker
+REFERENCE_DOWNLOAD_CONCURRENCY = 5  # In-flight reference downloads per /generate request
+FILE_UPLOAD_CONCURRENCY = 5         # In-flight Gemini File API uploads per /generate request
+REFERENCE_CACHE_MAX_ENTRIES = 128   # Prepared reference images kept in memory (~100-300 KB each)
+REFERENCE_CACHE_TTL_SECONDS = 3600
+ANALYSIS_CACHE_VERSION = "v1"       # Bump whenever ANALYZE_PROMPT or ImageAnalysisResult changes
+ANALYSIS_CACHE_MAX_ENTRIES = 4096   # In-process analyses kept in front of the image_analysis_cache table
+ANALYSIS_CACHE_TTL_SECONDS = 24 * 3600
+ANONYMOUS_ANALYZE_IMAGES_PER_HOUR = 20  # Free-try images per client IP on the dataset analyze endpoints
+
+# Prepared (downloaded, resized, re-encoded) reference images keyed by image URL.
+# Storage paths are unique per upload, so a URL's content never changes and
+# popular datasets skip both the download and the PIL work on repeat generations.
+_reference_image_cache = TTLCache(maxsize=REFERENCE_CACHE_MAX_ENTRIES, ttl=REFERENCE_CACHE_TTL_SECONDS)
+
+# Normalized embeddings of retrieval queries, so retries and repeated prompts
+# skip the embedding round-trip (keys include EMBEDDING_MODEL/DIMENSIONS via _embedding_hash)
+_prompt_embedding_cache = TTLCache(maxsize=PROMPT_EMBEDDING_CACHE_MAX_ENTRIES, ttl=PROMPT_EMBEDDING_CACHE_TTL_SECONDS)
+# Image embeddings computed by this process, keyed by _embedding_hash, until
+# the stored copy (written after the response) shows up in the dataset rows.
+# Every entry is one float32 vector of EMBEDDING_DIMENSIONS, so the entry cap
+# bounds the memory at IMAGE_EMBEDDING_CACHE_MAX_BYTES.
+_image_embedding_cache = TTLCache(
+    maxsize=IMAGE_EMBEDDING_CACHE_MAX_BYTES // (EMBEDDING_DIMENSIONS * 4),
+    ttl=IMAGE_EMBEDDING_CACHE_TTL_SECONDS,
+)
+
+# Gemini analyses keyed by image content (see _analysis_cache_key), so the same
+# bytes uploaded again or shared across datasets are never analyzed twice
+_analysis_cache = TTLCache(maxsize=ANALYSIS_CACHE_MAX_ENTRIES, ttl=ANALYSIS_CACHE_TTL_SECONDS)
+# image URL -> (ETag, analysis cache key) for URLs analyzed by analyze-fast
+_analysis_url_index = TTLCache(maxsize=ANALYSIS_CACHE_MAX_ENTRIES, ttl=ANALYSIS_CACHE_TTL_SECONDS)
+# Set once the image_analysis_cache table turns out not to exist or not to be
+# accessible with our key (setup_image_analysis_cache.sql)
+_analysis_table_missing = False
+# Set once dataset_images turns out not to have the embedding columns (setup_dataset_image_embeddings.sql)
+_embedding_columns_missing = False
+# Set once the match_dataset_images function turns out not to exist (same script)
+_match_function_missing = False
+# Set once deduct_credits turns out not to exist or not to be executable by our key
+# (setup_deduct_credits.sql)
+_deduct_function_unavailable = False
+# Same for analyze_commit (setup_analyze_commit.sql)
+_commit_function_unavailable = False
+
+# Anonymous free tries, one token per image, per client IP (per worker, in memory)
+_anonymous_analyze_limiter = TokenBucketLimiter(
+    capacity=ANONYMOUS_ANALYZE_IMAGES_PER_HOUR,
+    refill_per_second=ANONYMOUS_ANALYZE_IMAGES_PER_HOUR / 3600,
+)
+
+# Shared by every /generate request in this worker
+_image_generation_semaphore = asyncio.Semaphore(IMAGE_GENERATION_CONCURRENCY)
+
+
+# Aspect ratios accepted by the image model; anything else falls back to 1:1
+SUPPORTED_ASPECT_RATIOS = frozenset({
+    "1:1", "16:9", "9:16", "4:3", "3:4", "2:3", "3:2", "4:5", "5:4", "21:9",
+})
+
+# Style classes the analysis prompt assigns (ANALYZE_PROMPT's image_style list).
+# Client-supplied styles are matched against every spelling in one dict lookup:
+# "Oil Painting", "oil-painting" and "oil_painting" all map to "oil_painting".
+IMAGE_STYLES = get_args(ImageStyle)
+_STYLE_ALIASES = {
+    variant: style
+    for style in IMAGE_STYLES
+    for variant in (style, style.replace("_", " "), style.replace("_", "-"), style.replace("_", ""))
+}
+
+# ─── Prompts ──────────────────────────────────────────────────────
+# Universal analysis prompt — works on any image type (not domain-specific)
+ANALYZE_PROMPT = """You are a universal image analysis engine. Analyze this image regardless of its subject matter — it could be architecture, food, fashion, nature, products, people, art, vehicles, technology, or anything else.
+
+Extract the following and return as JSON:
+
+- "description": A rich, detailed description of what the image contains — the subject, composition, setting, notable objects, textures, materials, and any distinctive visual characteristics. Be specific and thorough.
+- "tags": A list of 8-12 specific, descriptive keywords covering: the primary subject, secondary elements, materials/textures, style characteristics, and any unique or distinguishing features. Use concrete nouns and adjectives (e.g., 'Exposed Brick Wall', 'Shallow Depth of Field', 'Velvet Fabric', 'Golden Hour Light', 'Minimalist Layout').
+- "lighting": Specific lighting description — type (natural, artificial, studio, ambient, neon, mixed), direction (front-lit, back-lit, side-lit, overhead), quality (soft, harsh, diffused, dramatic), and color temperature (warm, cool, neutral).
+- "colors": The dominant color palette as a list of 3-6 specific colors or tones (e.g., 'warm amber', 'matte black', 'dusty rose', 'forest green').
+- "vibe": The overall mood, atmosphere, or emotional tone (e.g., 'cozy and intimate', 'clean and professional', 'gritty urban', 'dreamy and ethereal').
+- "theme": The broad category or subject theme of the image (e.g., 'interior design', 'food photography', 'street fashion', 'landscape', 'product shot', 'portrait', 'architecture', 'abstract art').
+- "image_style": Classify the visual/production style of the image into ONE of these categories: 'photorealistic', 'cinematic', 'illustration', 'graphic_design', '3d_render', 'watercolor', 'oil_painting', 'sketch', 'pixel_art', 'anime', 'vintage_film', 'documentary', 'editorial', 'studio_product', 'aerial', 'macro', 'minimalist', 'surreal', 'pop_art', or 'other'. Pick the single best match.
+- "key_elements": A list of 3-5 of the most visually significant and unique elements that define this specific image — the things that make it distinctive and would need to be replicated to recreate a similar image.
+
+Output valid JSON only."""
+
+# Built once and shared by both analyze endpoints. It always leads the request,
+# so Gemini's implicit prefix caching can reuse it across calls.
+ANALYZE_PROMPT_PART = types.Part.from_text(text=ANALYZE_PROMPT)
+
+# Generation prompt used when reference images are attached, filled in with a
+# single format_map() per request. {style_notes} is empty or a full sentence.
+REFERENCE_PROMPT_TEMPLATE = (
+    "Using the provided reference images as visual ground truth, generate one final image. "
+    "Preserve the most important subject identity, composition language, lighting behavior, "
+    "texture/material treatment, and overall color palette from those references. "
+    "User request: {prompt}. "
+    "Target style class: {image_style}.{style_notes}"
+)
 
 
 def _build_image_search_text(analysis: dict) -> str:
@@ -95,6 +222,41 @@ def _build_image_search_text(analysis: dict) -> str:
     return ". ".join(parts)
 
 
+# ─── Prompt parsing tables ────────────────────────────────────────
+# Compiled once at import instead of per call
+_WHITESPACE_RE = re.compile(r"\s+")
+_CHAT_HISTORY_RE = re.compile(r"\bchat\s*history\s*:\s*", re.IGNORECASE)
+_EMPTY_BUSINESS_CONTEXT_RE = re.compile(
+    r"\bBusiness\s*Context\s*:\s*Business\s*:\s*(?:N/?A|None)\s*"
+    r"Theme\s*:\s*(?:N/?A|None)\s*Vibe\s*:\s*(?:N/?A|None)\s*"
+    r"Customer\s*:\s*(?:N/?A|None)\b\.?",
+    re.IGNORECASE,
+)
+_EMPTY_BUSINESS_FIELDS_RE = re.compile(
+    r"\bBusiness\s*:\s*(?:N/?A|None)\s*Theme\s*:\s*(?:N/?A|None)\s*"
+    r"Vibe\s*:\s*(?:N/?A|None)\s*Customer\s*:\s*(?:N/?A|None)\b\.?",
+    re.IGNORECASE,
+)
+_ROLE_PREFIX_RE = re.compile(r"\b(?:user|assistant)\s*:\s*", re.IGNORECASE)
+_ORPHAN_AT_RE = re.compile(r"@\s*(?=$|[.,;:!?])")
+_SPACE_BEFORE_PUNCT_RE = re.compile(r"\s+([,.;:!?])")
+# Path mentions like @Character/sauban or @new environment/braun notes
+_PATH_MENTION_RE = re.compile(
+    r"@\s*([A-Za-z0-9][A-Za-z0-9 _-]{0,64})\s*/\s*([A-Za-z0-9][A-Za-z0-9 _-]{0,96})"
+)
+# Plain mentions like @sauban (skip those that are actually @env/folder)
+_PLAIN_MENTION_RE = re.compile(r"@\s*([A-Za-z0-9][A-Za-z0-9 _-]{0,96})(?!\s*/)")
+
+# Words that end a free-form @mention phrase
+MENTION_STOP_WORDS = frozenset({
+    "standing", "holding", "wearing", "with", "without", "in", "on", "at",
+    "front", "of", "near", "beside", "behind", "under", "over", "and",
+    "context", "business", "theme", "vibe", "customer", "prompt",
+})
+# Business-context boilerplate that looks like a plain @mention
+IGNORED_MENTIONS = frozenset({"business context", "business", "theme", "vibe", "customer", "n a", "na"})
+
+
 def _normalize_lookup_text(value: str) -> str:
     """Normalize text for robust exact/fuzzy matching."""
     if not value:
@@ -110,20 +272,15 @@ def _trim_mention_phrase(raw: str) -> str:
     if not raw:
         return ""
     text = raw.strip().strip("/").strip()
-    text = re.sub(r"\s+", " ", text)
+    text = _WHITESPACE_RE.sub(" ", text)
 
-    stop_words = {
-        "standing", "holding", "wearing", "with", "without", "in", "on", "at",
-        "front", "of", "near", "beside", "behind", "under", "over", "and",
-        "context", "business", "theme", "vibe", "customer", "prompt",
-    }
     tokens = text.split(" ")
     kept = []
     for token in tokens:
         t = token.lower().strip()
         if t.endswith(":"):
             break
-        if t in stop_words:
+        if t in MENTION_STOP_WORDS:
             break
         kept.append(token)
         if len(kept) >= 6:
@@ -144,32 +301,19 @@ def _sanitize_prompt_for_generation(raw_prompt: str) -> str:
     text = raw_prompt.strip()
 
     # Keep only the current request text, drop appended transcript blocks.
-    text = re.split(r"\bchat\s*history\s*:\s*", text, maxsplit=1, flags=re.IGNORECASE)[0]
+    text = _CHAT_HISTORY_RE.split(text, maxsplit=1)[0]
 
     # Remove boilerplate context blocks when all values are effectively empty.
-    text = re.sub(
-        r"\bBusiness\s*Context\s*:\s*Business\s*:\s*(?:N/?A|None)\s*"
-        r"Theme\s*:\s*(?:N/?A|None)\s*Vibe\s*:\s*(?:N/?A|None)\s*"
-        r"Customer\s*:\s*(?:N/?A|None)\b\.?",
-        "",
-        text,
-        flags=re.IGNORECASE,
-    )
-    text = re.sub(
-        r"\bBusiness\s*:\s*(?:N/?A|None)\s*Theme\s*:\s*(?:N/?A|None)\s*"
-        r"Vibe\s*:\s*(?:N/?A|None)\s*Customer\s*:\s*(?:N/?A|None)\b\.?",
-        "",
-        text,
-        flags=re.IGNORECASE,
-    )
+    text = _EMPTY_BUSINESS_CONTEXT_RE.sub("", text)
+    text = _EMPTY_BUSINESS_FIELDS_RE.sub("", text)
 
     # Remove leaked transcript role prefixes.
-    text = re.sub(r"\b(?:user|assistant)\s*:\s*", "", text, flags=re.IGNORECASE)
+    text = _ROLE_PREFIX_RE.sub("", text)
 
     # Clean up orphan '@' markers and whitespace artifacts.
-    text = re.sub(r"@\s*(?=$|[.,;:!?])", "", text)
-    text = re.sub(r"\s+", " ", text).strip()
-    text = re.sub(r"\s+([,.;:!?])", r"\1", text)
+    text = _ORPHAN_AT_RE.sub("", text)
+    text = _WHITESPACE_RE.sub(" ", text).strip()
+    text = _SPACE_BEFORE_PUNCT_RE.sub(r"\1", text)
 
     return text
 
@@ -187,45 +331,33 @@ def _extract_prompt_dataset_mentions(prompt: str) -> tuple[list[tuple[str, str]]
     path_mentions = []
     plain_mentions = []
 
-    # Path mentions like @Character/sauban or @new environment/braun notes
-    path_pattern = re.compile(
-        r"@\s*([A-Za-z0-9][A-Za-z0-9 _-]{0,64})\s*/\s*([A-Za-z0-9][A-Za-z0-9 _-]{0,96})"
-    )
-    for match in path_pattern.finditer(prompt):
+    for match in _PATH_MENTION_RE.finditer(prompt):
         env_raw = _trim_mention_phrase(match.group(1))
         folder_raw = _trim_mention_phrase(match.group(2))
         if env_raw and folder_raw:
             path_mentions.append((env_raw, folder_raw))
 
-    # Plain mentions like @sauban (skip those that are actually @env/folder)
-    plain_pattern = re.compile(r"@\s*([A-Za-z0-9][A-Za-z0-9 _-]{0,96})(?!\s*/)")
-    for match in plain_pattern.finditer(prompt):
+    for match in _PLAIN_MENTION_RE.finditer(prompt):
         mention = _trim_mention_phrase(match.group(1))
         if not mention:
             continue
         mention_norm = _normalize_lookup_text(mention)
-        if mention_norm in {"business context", "business", "theme", "vibe", "customer", "n a", "na"}:
+        if mention_norm in IGNORED_MENTIONS:
             continue
         plain_mentions.append(mention)
 
-    # De-duplicate while preserving order
-    seen_path = set()
-    uniq_path = []
+    # De-duplicate while preserving order (dicts keep insertion order; the
+    # first spelling of each normalized mention wins)
+    uniq_path = {}
     for env_name, folder_name in path_mentions:
         key = (_normalize_lookup_text(env_name), _normalize_lookup_text(folder_name))
-        if key not in seen_path:
-            seen_path.add(key)
-            uniq_path.append((env_name, folder_name))
+        uniq_path.setdefault(key, (env_name, folder_name))
 
-    seen_plain = set()
-    uniq_plain = []
+    uniq_plain = {}
     for mention in plain_mentions:
-        key = _normalize_lookup_text(mention)
-        if key not in seen_plain:
-            seen_plain.add(key)
-            uniq_plain.append(mention)
+        uniq_plain.setdefault(_normalize_lookup_text(mention), mention)
 
-    return uniq_path, uniq_plain
+    return list(uniq_path.values()), list(uniq_plain.values())
 
 
 def _fuzzy_match_key(query: str, keys: list[str], cutoff: float = MENTION_FUZZY_CUTOFF) -> str | None:
@@ -265,7 +397,45 @@ def _match_dataset_by_name(query: str, datasets: list[dict]) -> dict | None:
     return None
 
 
-def _resolve_referenced_dataset_ids(
+async def _load_dataset_listing(supabase: Client, user_id: str | None) -> tuple[list, dict, dict]:
+    """
+    The caller's folders plus two lookups: normalized environment name ->
+    environment ids (every environment, with or without folders), and
+    environment id -> folders.
+    Served from dataset_listing_cache when fresh; callers must not mutate the result.
+    """
+    listing = dataset_listing_cache.get(user_id)
+    if listing is not None:
+        return listing
+
+    # Every environment is listed, including ones without folders: a mention of
+    # an empty environment must match it rather than fuzzy-match another one.
+    ds_query = supabase.table("datasets").select("id, name, environment_id, user_id")
+    env_query = supabase.table("environments").select("id, name, user_id")
+    if user_id:
+        ds_query = ds_query.eq("user_id", user_id)
+        env_query = env_query.eq("user_id", user_id)
+
+    # Independent reads - run them concurrently off the event loop
+    ds_res, env_res = await asyncio.gather(execute_async(ds_query), execute_async(env_query))
+    datasets = ds_res.data or []
+
+    env_name_to_ids = {}
+    for env in env_res.data or []:
+        env_name_norm = _normalize_lookup_text(env.get("name", ""))
+        if env_name_norm:
+            env_name_to_ids.setdefault(env_name_norm, []).append(env.get("id"))
+
+    datasets_by_env = {}
+    for ds in datasets:
+        datasets_by_env.setdefault(ds.get("environment_id"), []).append(ds)
+
+    listing = (datasets, env_name_to_ids, datasets_by_env)
+    dataset_listing_cache.set(user_id, listing)
+    return listing
+
+
+async def _resolve_referenced_dataset_ids(
     supabase: Client,
     prompt: str,
     current_user=None,
@@ -286,28 +456,12 @@ def _resolve_referenced_dataset_ids(
         return resolved_ids
 
     try:
-        ds_query = supabase.table("datasets").select("id, name, environment_id, user_id")
-        env_query = supabase.table("environments").select("id, name, user_id")
-        if current_user:
-            user_id = str(current_user.id)
-            ds_query = ds_query.eq("user_id", user_id)
-            env_query = env_query.eq("user_id", user_id)
-
-        datasets = ds_query.execute().data or []
-        environments = env_query.execute().data or []
+        datasets, env_name_to_ids, datasets_by_env = await _load_dataset_listing(
+            supabase, str(current_user.id) if current_user else None
+        )
         if not datasets:
             return resolved_ids
 
-        env_name_to_ids = {}
-        for env in environments:
-            env_name_norm = _normalize_lookup_text(env.get("name", ""))
-            if env_name_norm:
-                env_name_to_ids.setdefault(env_name_norm, []).append(env.get("id"))
-
-        datasets_by_env = {}
-        for ds in datasets:
-            datasets_by_env.setdefault(ds.get("environment_id"), []).append(ds)
-
         path_mentions, plain_mentions = _extract_prompt_dataset_mentions(prompt)
 
         matched_descriptions = []
@@ -320,9 +474,9 @@ def _resolve_referenced_dataset_ids(
                 if ds_id and ds_id not in resolved_ids:
                     resolved_ids.append(ds_id)
             if preferred_env_datasets:
-                print(
-                    f"Environment scope resolved: {len(preferred_env_datasets)} folders "
-                    f"from environment_id={preferred_environment_id}"
+                logger.info(
+                    "Environment scope resolved: %s folders from environment_id=%s",
+                    len(preferred_env_datasets), preferred_environment_id,
                 )
 
         # Resolve @Environment/Folder references first
@@ -352,15 +506,81 @@ def _resolve_referenced_dataset_ids(
                 matched_descriptions.append(f"@{mention} -> {matched.get('name')}")
 
         if matched_descriptions:
-            print("Resolved prompt references: " + "; ".join(matched_descriptions))
+            logger.info("Resolved prompt references: %s", "; ".join(matched_descriptions))
 
         return resolved_ids
 
     except Exception as e:
-        print(f"Warning: Could not resolve prompt references: {e}")
+        logger.warning("Could not resolve prompt references: %s", e)
         return resolved_ids
 
 
+def _get_dataset_with_images(supabase: Client, dataset_id: str) -> tuple[dict | None, list[dict]]:
+    """
+    The dataset's name/master_prompt and all its images (up to
+    MAX_DATASET_IMAGES_FETCH, tagged with their source dataset id), fetched
+    in one embedded PostgREST query. Served from the dataset caches when fresh.
+    """
+    row = dataset_cache.get(dataset_id)
+    images = dataset_images_cache.get(dataset_id)
+    if row is not None and images is not None:
+        return row, images
+
+    global _embedding_columns_missing
+    image_columns = "image_url, analysis_result, created_at"
+    if not _embedding_columns_missing:
+        # With the embedding hash, _find_relevant_images_semantic can rank the
+        # stored embeddings in Postgres and embed only the prompt
+        image_columns = f"id, {image_columns}, embedding_hash"
+    try:
+        res = (
+            supabase
+            .table("datasets")
+            .select(f"name, master_prompt, dataset_images({image_columns})")
+            .eq("id", dataset_id)
+            .limit(MAX_DATASET_IMAGES_FETCH, foreign_table="dataset_images")
+            .limit(1)
+            .execute()
+        )
+    except PostgrestAPIError as e:
+        if _embedding_columns_missing or e.code != "42703":  # 42703: undefined column
+            raise
+        _embedding_columns_missing = True
+        return _get_dataset_with_images(supabase, dataset_id)
+    if not res.data:
+        return None, []
+
+    row = res.data[0]
+    images = row.pop("dataset_images", None) or []
+    for image in images:
+        image["source_dataset_id"] = dataset_id
+    dataset_cache.set(dataset_id, row)
+    dataset_images_cache.set(dataset_id, images)
+    return row, images
+
+
+async def _load_datasets_with_images(supabase: Client, dataset_ids: list[str]) -> list[tuple[str, dict, list[dict]]]:
+    """
+    Fetch the dataset row and image list for every id concurrently.
+    Returns (dataset_id, dataset_row, images) in input order, skipping
+    datasets that are missing or fail to load.
+    """
+    results = await asyncio.gather(
+        *(asyncio.to_thread(_get_dataset_with_images, supabase, ds_id) for ds_id in dataset_ids),
+        return_exceptions=True,
+    )
+
+    loaded = []
+    for ds_id, result in zip(dataset_ids, results):
+        if isinstance(result, Exception):
+            logger.warning("Could not fetch dataset %s: %s", ds_id, result)
+            continue
+        dataset_row, images = result
+        if dataset_row:
+            loaded.append((ds_id, dataset_row, images))
+    return loaded
+
+
 def _build_relevance_query(
     prompt: str,
     image_style: str = "",
@@ -384,28 +604,99 @@ def _build_relevance_query(
     return ". ".join(parts)
 
 
+_JSON_FENCE_RE = re.compile(r"^\s*```(?:json)?|```\s*$")
+
+
 def _extract_json_text(raw_text: str) -> str:
     """Extract JSON payload from plain/fenced model output."""
     if not raw_text:
         return ""
-    text = raw_text.strip()
-    if text.startswith("```json"):
-        text = text[7:]
-    if text.startswith("```"):
-        text = text[3:]
-    if text.endswith("```"):
-        text = text[:-3]
-    return text.strip()
-
-
-def _cosine_similarity(vec_a: list, vec_b: list) -> float:
-    """Compute cosine similarity between two vectors. Returns -1 to 1."""
-    dot = sum(a * b for a, b in zip(vec_a, vec_b))
-    mag_a = sum(a * a for a in vec_a) ** 0.5
-    mag_b = sum(b * b for b in vec_b) ** 0.5
-    if mag_a == 0 or mag_b == 0:
-        return 0.0
-    return dot / (mag_a * mag_b)
+    return _JSON_FENCE_RE.sub("", raw_text).strip()
+
+
+def _normalized_rows(vectors: list) -> "np.ndarray":
+    """Stack embedding vectors into a float32 matrix with unit-length rows (zero rows stay zero)."""
+    matrix = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+def _top_k_indices(scores: "np.ndarray", k: int) -> "np.ndarray":
+    """Indices of the k highest scores, best first, without sorting the whole array."""
+    if k < len(scores):
+        top = np.argpartition(-scores, k - 1)[:k]
+    else:
+        top = np.arange(len(scores))
+    return top[np.argsort(-scores[top], kind="stable")]
+
+
+def _embed_texts(gemini_client, texts: list) -> list:
+    """Embed texts with EMBEDDING_MODEL, EMBED_BATCH_SIZE per call. Returns the vectors in input order."""
+    vectors = []
+    for start in range(0, len(texts), EMBED_BATCH_SIZE):
+        batch_embed = gemini_client.models.embed_content(
+            model=EMBEDDING_MODEL,
+            contents=texts[start:start + EMBED_BATCH_SIZE],
+            config=types.EmbedContentConfig(
+                task_type="SEMANTIC_SIMILARITY",
+                output_dimensionality=EMBEDDING_DIMENSIONS,
+            ),
+        )
+        vectors.extend(embedding.values for embedding in batch_embed.embeddings)
+    return vectors
+
+
+def _embedding_hash(search_text: str) -> str:
+    """Key of an image embedding: changes with the analysis text, the model or the dimensions."""
+    return hashlib.sha256(f"{EMBEDDING_MODEL}:{EMBEDDING_DIMENSIONS}:{search_text}".encode()).hexdigest()
+
+
+def _match_stored_embeddings(
+    supabase: Client, prompt_vector: "np.ndarray", images: list, match_count: int
+) -> dict | None:
+    """
+    Cosine similarity to the prompt of the best `match_count` stored embeddings
+    in the images' datasets, ranked in Postgres (match_dataset_images) so the
+    vectors never leave the database. Returns {image id: similarity}, or None
+    if the function isn't available.
+    """
+    global _match_function_missing
+    if _match_function_missing:
+        return None
+    dataset_ids = list(dict.fromkeys(img["source_dataset_id"] for img in images))
+    try:
+        res = supabase.rpc("match_dataset_images", {
+            "query_embedding": prompt_vector.tolist(),
+            "dataset_ids": dataset_ids,
+            "match_count": match_count,
+        }).execute()
+    except PostgrestAPIError as e:
+        if e.code == "PGRST202":  # Function not created yet - stop asking
+            _match_function_missing = True
+        else:
+            logger.warning("Stored embedding ranking failed: %s", e.message)
+        return None
+    return {row["id"]: row["similarity"] for row in res.data or []}
+
+
+def _store_image_embeddings(supabase: Client, rows: list) -> None:
+    """Persist embeddings computed by _find_relevant_images_semantic (run after the response)."""
+    global _embedding_columns_missing
+    if _embedding_columns_missing:
+        return
+    for row in rows:
+        try:
+            (
+                supabase.table("dataset_images")
+                .update({"embedding": row["embedding"], "embedding_hash": row["embedding_hash"]}, returning="minimal")
+                .eq("id", row["id"])
+                .execute()
+            )
+        except PostgrestAPIError as e:
+            if e.code in ("PGRST204", "42703"):  # Columns not created yet - stop trying
+                _embedding_columns_missing = True
+                return
+            logger.warning("Could not store embedding for dataset image %s: %s", row["id"], e.message)
 
 
 def _find_relevant_images_semantic(
@@ -413,6 +704,8 @@ def _find_relevant_images_semantic(
     prompt: str,
     images_data: list,
     max_images: int = MODEL_MAX_REFERENCE_IMAGES,
+    fresh_embeddings: list | None = None,
+    supabase: Client | None = None,
 ) -> list:
     """
     Use Gemini Embedding API to find the most semantically relevant
@@ -421,10 +714,19 @@ def _find_relevant_images_semantic(
     How it works:
       1. Build search text from image analysis_result
          (tags, description, key_elements, theme, style, vibe, colors, lighting).
-      2. Embed the prompt once.
-      3. Embed image texts in batches (scales to large folders).
-      4. Score each image by cosine similarity, sort descending, return top N.
+      2. Embed the prompt once (cached in _prompt_embedding_cache).
+      3. Images with a stored embedding for the same text (see _embedding_hash)
+         are ranked against the prompt in Postgres (_match_stored_embeddings,
+         pgvector), which returns only the best matches and their scores.
+      4. Embed, in batches, the remaining image texts. Those new embeddings are
+         kept in _image_embedding_cache and appended to `fresh_embeddings` for
+         the caller to persist with _store_image_embeddings. They, and any
+         still in that cache from earlier calls, are scored here in one
+         matrix-vector product (unit-length vectors, so cosine is a dot product).
+      5. Return the top N by cosine similarity across both.
     
+    When there are no more images than max_images, all of them are returned
+    (analyzed ones first) without embedding anything.
     Falls back to returning the first N images if embedding fails.
     """
     # Build search text for each image
@@ -440,40 +742,86 @@ def _find_relevant_images_semantic(
             fallback_only.append(img)
     
     if not scorable:
-        print("No analyzed images found — using first images as fallback")
+        logger.info("No analyzed images found — using first images as fallback")
         return images_data[:max_images]
+
+    if len(images_data) <= max_images:
+        # Every image is selected whatever the scores - skip the embedding calls
+        logger.info("Semantic relevance ranking skipped — all %s images fit in %s", len(images_data), max_images)
+        return [img for img, _ in scorable] + fallback_only
     
     try:
-        prompt_embed = gemini_client.models.embed_content(
-            model="gemini-embedding-001",
-            contents=[prompt],
-            config=types.EmbedContentConfig(
-                task_type="SEMANTIC_SIMILARITY",
-            ),
+        prompt_key = _embedding_hash(prompt)
+        prompt_vector = _prompt_embedding_cache.get(prompt_key)
+        if prompt_vector is None:
+            prompt_vector = _normalized_rows(_embed_texts(gemini_client, [prompt]))[0]
+            _prompt_embedding_cache.set(prompt_key, prompt_vector)
+
+        # Split images by where their embedding is: computed by this process
+        # (_image_embedding_cache), stored in Postgres, or not computed for this
+        # text. The (shared, cached) rows themselves are only read.
+        hashes = [_embedding_hash(search_text) for _, search_text in scorable]
+        stored, local_vectors, missing = [], {}, []
+        for i, ((img, _), embedding_hash) in enumerate(zip(scorable, hashes)):
+            vector = _image_embedding_cache.get(embedding_hash)
+            if vector is not None:
+                local_vectors[i] = vector
+            elif img.get("embedding_hash") == embedding_hash:
+                stored.append(i)
+            else:
+                missing.append(i)
+
+        scores = {}  # scorable index -> cosine similarity to the prompt
+        if stored:
+            # Rows scored here (new, re-analyzed or embedded by this process) may
+            # also have an embedding in Postgres and take slots in its ranking
+            # that are then skipped. Asking for one extra match per such row
+            # guarantees the database's top max_images of the `stored` rows are
+            # all returned, so the merge below equals a full ranking.
+            # The function ranks exactly (no approximate index), so a short
+            # result means every stored embedding was returned: `stored` rows
+            # missing from it have no embedding in Postgres any more and are
+            # embedded here instead of being dropped.
+            matched = None
+            match_count = max_images + len(missing) + len(local_vectors)
+            if supabase is not None:
+                matched = _match_stored_embeddings(
+                    supabase, prompt_vector, [scorable[i][0] for i in stored], match_count,
+                )
+            if matched is None:
+                missing.extend(stored)
+            else:
+                for i in stored:
+                    similarity = matched.get(scorable[i][0]["id"])
+                    if similarity is not None:
+                        scores[i] = similarity
+                    elif len(matched) < match_count:
+                        missing.append(i)
+
+        logger.debug(
+            "Ranking %s analyzed images with Gemini embeddings (%s ranked in Postgres, %s to embed, batch size=%s)...",
+            len(scorable), len(scorable) - len(missing) - len(local_vectors), len(missing), EMBED_BATCH_SIZE,
         )
-        prompt_embedding = prompt_embed.embeddings[0].values
-        
-        print(f"Ranking {len(scorable)} analyzed images with Gemini embeddings (batch size={EMBED_BATCH_SIZE})...")
-
-        # Score each image by cosine similarity to the prompt, in batches
-        scored = []
-        for start in range(0, len(scorable), EMBED_BATCH_SIZE):
-            batch = scorable[start:start + EMBED_BATCH_SIZE]
-            batch_texts = [search_text for _, search_text in batch]
-            batch_embed = gemini_client.models.embed_content(
-                model="gemini-embedding-001",
-                contents=batch_texts,
-                config=types.EmbedContentConfig(task_type="SEMANTIC_SIMILARITY"),
-            )
-            for (img, _), img_embedding in zip(batch, batch_embed.embeddings):
-                similarity = _cosine_similarity(prompt_embedding, img_embedding.values)
-                scored.append((similarity, img))
-        
-        # Sort by similarity descending
-        scored.sort(key=lambda x: x[0], reverse=True)
-        
-        # Select top N
-        selected_scored = scored[:max_images]
+        if missing:
+            new_vectors = _embed_texts(gemini_client, [scorable[i][1] for i in missing])
+            for i, values in zip(missing, new_vectors):
+                img = scorable[i][0]
+                local_vectors[i] = np.asarray(values, dtype=np.float32)
+                _image_embedding_cache.set(hashes[i], local_vectors[i])
+                if fresh_embeddings is not None and img.get("id"):
+                    fresh_embeddings.append({"id": img["id"], "embedding": list(values), "embedding_hash": hashes[i]})
+
+        if local_vectors:
+            local_similarities = _normalized_rows(list(local_vectors.values())) @ prompt_vector
+            scores.update(zip(local_vectors, local_similarities.tolist()))
+
+        # Top N by score across both
+        ranked_indices = list(scores)
+        similarities = np.fromiter(scores.values(), dtype=np.float32, count=len(scores))
+        selected_scored = [
+            (float(similarities[j]), scorable[ranked_indices[j]][0])
+            for j in _top_k_indices(similarities, max_images)
+        ]
         selected_images = [img for _, img in selected_scored]
 
         # If we still need images, append non-analyzed images as fallback
@@ -481,24 +829,40 @@ def _find_relevant_images_semantic(
             needed = max_images - len(selected_images)
             selected_images.extend(fallback_only[:needed])
         
-        print(f"Semantic relevance ranking — selected {len(selected_images)} of {len(images_data)} images:")
-        for rank, (sim, img) in enumerate(selected_scored, 1):
-            url = img.get('image_url', 'N/A')
-            short_url = url.split('/')[-1] if url else 'N/A'
-            # Show a few top tags for context
-            tags = img.get('analysis_result', {}).get('tags', [])
-            top_tags = ', '.join(tags[:4]) if tags else 'no tags'
-            print(f"  #{rank}: similarity={sim:.4f}  [{top_tags}]  {short_url}")
+        logger.info("Semantic relevance ranking — selected %s of %s images", len(selected_images), len(images_data))
+        if logger.isEnabledFor(logging.DEBUG):
+            for rank, (sim, img) in enumerate(selected_scored, 1):
+                url = img.get('image_url', 'N/A')
+                short_url = url.split('/')[-1] if url else 'N/A'
+                # Show a few top tags for context
+                tags = img.get('analysis_result', {}).get('tags', [])
+                top_tags = ', '.join(tags[:4]) if tags else 'no tags'
+                logger.debug("  #%s: similarity=%.4f  [%s]  %s", rank, sim, top_tags, short_url)
         
         return selected_images
         
     except Exception as e:
         # If embedding fails (API error, quota, etc.), fall back to first N
-        print(f"Warning: Semantic search failed ({e}), falling back to first {max_images} images")
+        logger.warning("Semantic search failed (%s), falling back to first %s images", e, max_images)
         return images_data[:max_images]
 
 
-def _rerank_images_with_vision(
+async def _download_image(image_url: str):
+    """GET an image through the shared pool. Returns (bytes, mime_type) or None on failure."""
+    try:
+        response = await async_http_client.get(image_url)
+    except Exception as e:
+        logger.warning("Vision rerank could not load image %s: %s", image_url, e)
+        return None
+    if response.status_code != 200:
+        return None
+    mime_type = response.headers.get("content-type", "image/jpeg").split(";")[0].strip().lower()
+    if not mime_type.startswith("image/"):
+        mime_type = "image/jpeg"
+    return response.content, mime_type
+
+
+async def _rerank_images_with_vision(
     gemini_client,
     prompt: str,
     images_data: list,
@@ -535,27 +899,20 @@ def _rerank_images_with_vision(
         )
         parts.append(types.Part.from_text(text=instruction))
 
+        # Fetch the whole batch concurrently
+        batch = [img for img in batch if img.get("image_url")]
+        downloads = await asyncio.gather(*(_download_image(img["image_url"]) for img in batch))
+
         local_idx_to_img = {}
         local_idx = 1
-        for img in batch:
-            image_url = img.get("image_url")
-            if not image_url:
+        for img, downloaded in zip(batch, downloads):
+            if downloaded is None:
                 continue
-            try:
-                img_response = requests.get(image_url, timeout=10)
-                if img_response.status_code != 200:
-                    continue
-
-                mime_type = img_response.headers.get("content-type", "image/jpeg").split(";")[0].strip().lower()
-                if not mime_type.startswith("image/"):
-                    mime_type = "image/jpeg"
-
-                parts.append(types.Part.from_text(text=f"Candidate {local_idx}"))
-                parts.append(types.Part.from_bytes(data=img_response.content, mime_type=mime_type))
-                local_idx_to_img[local_idx] = img
-                local_idx += 1
-            except Exception as img_err:
-                print(f"Warning: Vision rerank could not load image {image_url}: {img_err}")
+            image_bytes, mime_type = downloaded
+            parts.append(types.Part.from_text(text=f"Candidate {local_idx}"))
+            parts.append(types.Part.from_bytes(data=image_bytes, mime_type=mime_type))
+            local_idx_to_img[local_idx] = img
+            local_idx += 1
 
         if not local_idx_to_img:
             continue
@@ -563,7 +920,7 @@ def _rerank_images_with_vision(
         response = None
         for attempt in range(1, VISION_RERANK_MAX_RETRIES + 1):
             try:
-                response = gemini_client.models.generate_content(
+                response = await gemini_client.aio.models.generate_content(
                     model="gemini-3-flash-preview",
                     contents=[types.Content(role="user", parts=parts)],
                     config=types.GenerateContentConfig(
@@ -575,15 +932,15 @@ def _rerank_images_with_vision(
             except Exception as rerank_err:
                 if attempt < VISION_RERANK_MAX_RETRIES:
                     delay = VISION_RERANK_RETRY_BASE_DELAY ** attempt
-                    print(
-                        f"Vision rerank batch failed on attempt {attempt}/{VISION_RERANK_MAX_RETRIES}. "
-                        f"Retrying in {delay}s... Error: {rerank_err}"
+                    logger.warning(
+                        "Vision rerank batch failed on attempt %s/%s. Retrying in %ss... Error: %s",
+                        attempt, VISION_RERANK_MAX_RETRIES, delay, rerank_err,
                     )
-                    time.sleep(delay)
+                    await asyncio.sleep(delay)
                 else:
-                    print(
-                        f"Vision rerank batch failed on final attempt {attempt}/{VISION_RERANK_MAX_RETRIES}. "
-                        f"Falling back to semantic order. Error: {rerank_err}"
+                    logger.warning(
+                        "Vision rerank batch failed on final attempt %s/%s. Falling back to semantic order. Error: %s",
+                        attempt, VISION_RERANK_MAX_RETRIES, rerank_err,
                     )
                     hard_failure = True
 
@@ -592,7 +949,7 @@ def _rerank_images_with_vision(
 
         try:
             parsed_text = _extract_json_text(response.text if response and response.text else "")
-            parsed = json.loads(parsed_text) if parsed_text else {}
+            parsed = orjson.loads(parsed_text) if parsed_text else {}
             raw_scores = parsed.get("scores", []) if isinstance(parsed, dict) else []
             score_map = {}
             for row in raw_scores:
@@ -612,13 +969,13 @@ def _rerank_images_with_vision(
                 scored_ids.add(id(img))
 
         except Exception as parse_err:
-            print(f"Warning: Vision rerank response parsing failed: {parse_err}")
+            logger.warning("Vision rerank response parsing failed: %s", parse_err)
             hard_failure = True
             break
 
     # If vision rerank couldn't complete reliably, use semantic order directly.
     if hard_failure or not scored:
-        print("Vision rerank unavailable after retries — using semantic selection fallback")
+        logger.info("Vision rerank unavailable after retries — using semantic selection fallback")
         return images_data[:max_images]
 
     # Preserve semantic order as fallback for unscored images
@@ -637,30 +994,30 @@ def _rerank_images_with_vision(
         selected = [img for _, img in scored[:max_images]]
         mode = "top-ranked-fallback"
 
-    print(
-        f"Vision rerank selected {len(selected)} references from {len(images_data)} semantic candidates "
-        f"({mode})"
+    logger.info(
+        "Vision rerank selected %s references from %s semantic candidates (%s)",
+        len(selected), len(images_data), mode,
     )
     return selected
 
 
-def _resize_image_if_needed(pil_image: PILImage.Image, max_dim: int = MAX_IMAGE_DIMENSION) -> PILImage.Image:
-    """Resize image if either dimension exceeds max_dim, preserving aspect ratio."""
-    w, h = pil_image.size
-    if w <= max_dim and h <= max_dim:
+def _resize_image_if_needed(pil_image: "PILImage.Image", max_dim: int = MAX_IMAGE_DIMENSION) -> "PILImage.Image":
+    """
+    Downscale in place so neither side exceeds max_dim, preserving aspect ratio.
+    Must run before the image is loaded: for JPEGs, draft() lets the decoder
+    skip straight to a 1/2, 1/4 or 1/8 scale instead of decoding full size.
+    """
+    if max(pil_image.size) <= max_dim:
         return pil_image
-    
-    if w > h:
-        new_w = max_dim
-        new_h = int(h * (max_dim / w))
-    else:
-        new_h = max_dim
-        new_w = int(w * (max_dim / h))
-    
-    return pil_image.resize((new_w, new_h), PILImage.LANCZOS)
+
+    from PIL import Image as PILImage
+
+    pil_image.draft("RGB", (max_dim, max_dim))
+    pil_image.thumbnail((max_dim, max_dim), PILImage.LANCZOS)
+    return pil_image
 
 
-def _ensure_rgb_image(pil_image: PILImage.Image) -> PILImage.Image:
+def _ensure_rgb_image(pil_image: "PILImage.Image") -> "PILImage.Image":
     """
     Ensure image is in RGB mode for Gemini API compatibility.
     Some JPEGs/PNGs have RGBA, P (palette), or LA mode which can cause
@@ -673,33 +1030,124 @@ def _ensure_rgb_image(pil_image: PILImage.Image) -> PILImage.Image:
     return pil_image.convert("RGB")
 
 
+def _prepare_reference_image(data: bytes, mime_type: str = "") -> tuple[bytes, str, tuple[int, int]]:
+    """
+    Return (bytes, mime_type, size) for a reference image to send to Gemini.
+
+    PIL only reads the header here. RGB images within MAX_IMAGE_DIMENSION, in a
+    compressed format Gemini accepts (not PNG), are passed through as their
+    original bytes with no decode at all; anything else is decoded, converted
+    to RGB, resized and re-encoded as JPEG (several times smaller than PNG for
+    photos, with no loss that matters for style conditioning).
+    """
+    from PIL import Image as PILImage
+
+    with PILImage.open(io.BytesIO(data)) as pil_image:
+        size = pil_image.size
+        mime_type = PILImage.MIME.get(pil_image.format) or mime_type or "image/jpeg"
+        if (
+            pil_image.mode == "RGB"
+            and max(size) <= MAX_IMAGE_DIMENSION
+            and mime_type in PASSTHROUGH_IMAGE_MIME_TYPES
+        ):
+            return data, mime_type, size
+
+        prepared = _ensure_rgb_image(_resize_image_if_needed(pil_image))
+        # The with-block frees the encode buffer as soon as its bytes are taken
+        with io.BytesIO() as out:
+            prepared.save(out, format="JPEG", quality=REFERENCE_JPEG_QUALITY, optimize=True)
+            return out.getvalue(), "image/jpeg", prepared.size
+
+
+def _prepare_analysis_image(data: bytes, mime_type: str) -> tuple[bytes, str]:
+    """
+    Downscale an image for vision analysis (see _prepare_reference_image).
+    The stored upload stays full size; only Gemini gets the smaller copy.
+    Images PIL can't read are sent as they are.
+    """
+    try:
+        prepared, prepared_mime, _ = _prepare_reference_image(data, mime_type)
+    except Exception:
+        return data, mime_type
+    return prepared, prepared_mime
+
+
+async def _load_reference_image(image_url: str, semaphore: asyncio.Semaphore):
+    """
+    Return (bytes, mime_type, size) ready to send to Gemini for a reference image,
+    from _reference_image_cache when possible. None if it can't be loaded.
+    """
+    prepared = _reference_image_cache.get(image_url)
+    if prepared is not None:
+        return prepared
+    try:
+        async with semaphore:
+            response = await async_http_client.get(image_url)
+        if response.status_code != 200:
+            return None
+        content_type = response.headers.get("content-type", "").split(";")[0].strip().lower()
+        # Decode/resize/re-encode in a worker thread so the loop keeps serving
+        # the other downloads (Pillow releases the GIL while it works)
+        prepared = await asyncio.to_thread(_prepare_reference_image, response.content, content_type)
+    except Exception as img_error:
+        logger.warning("Could not load reference image %s: %s", image_url, img_error)
+        return None
+    _reference_image_cache.set(image_url, prepared)
+    return prepared
+
+
+# Strong references to fire-and-forget tasks until they finish
+_background_tasks: set[asyncio.Task] = set()
+
+
+def _spawn_background(coro) -> None:
+    """Run a coroutine in the background, independent of the request that started it."""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+async def _delete_gemini_files(client, files: list) -> None:
+    """Delete File API uploads once a generation is done with them."""
+    results = await asyncio.gather(
+        *(client.aio.files.delete(name=uploaded_file.name) for uploaded_file in files),
+        return_exceptions=True,
+    )
+    failed = sum(isinstance(result, Exception) for result in results)
+    if failed:
+        logger.debug("Could not delete %s of %s Gemini File API uploads", failed, len(files))
+
+
 async def _generate_with_retry(client, model: str, contents, config, max_retries: int = GEMINI_MAX_RETRIES):
     """Call Gemini generate_content with retry logic for transient 500 errors."""
     last_error = None
     for attempt in range(1, max_retries + 1):
         try:
-            response = client.models.generate_content(
-                model=model,
-                contents=contents,
-                config=config,
-            )
+            # Native async call: a multi-second generation doesn't hold a threadpool
+            # worker, and the semaphore keeps bursts within the Gemini rate limit
+            async with _image_generation_semaphore:
+                response = await client.aio.models.generate_content(
+                    model=model,
+                    contents=contents,
+                    config=config,
+                )
             return response
         except ServerError as e:
             last_error = e
             if attempt < max_retries:
                 delay = GEMINI_RETRY_BASE_DELAY ** attempt  # 2s, 4s, 8s
-                print(f"Gemini 500 error on attempt {attempt}/{max_retries}. Retrying in {delay}s... Error: {e}")
+                logger.warning("Gemini 500 error on attempt %s/%s. Retrying in %ss... Error: %s", attempt, max_retries, delay, e)
                 await asyncio.sleep(delay)
             else:
-                print(f"Gemini 500 error on final attempt {attempt}/{max_retries}. Giving up. Error: {e}")
+                logger.error("Gemini 500 error on final attempt %s/%s. Giving up. Error: %s", attempt, max_retries, e)
     raise last_error
 
 # Configure Gemini Client
 client = None
-if GOOGLE_API_KEY:
-    client = genai.Client(api_key=GOOGLE_API_KEY)
+if settings.GOOGLE_API_KEY:
+    client = genai.Client(api_key=settings.GOOGLE_API_KEY)
 
-router = APIRouter(prefix="/ai", tags=["AI"])
+router = APIRouter(prefix="/ai", tags=["AI"], default_response_class=ORJSONResponse)
 
 # ─── Credit cost per action ──────────────────────────────────────
 CREDIT_COSTS = {
@@ -708,11 +1156,26 @@ CREDIT_COSTS = {
     "analyze_dataset_per_image": 1,
 }
 
-def _deduct_credits(supabase: Client, user_id: str, action_type: str, credits: int, prompt: str = None, metadata: dict = None):
-    """Deduct credits from user balance and log the transaction + usage."""
+def _record_generation(supabase: Client, generation_record: dict):
+    """Insert a generated_images row. Run as a background task after /generate responds."""
     try:
+        supabase.table("generated_images").insert(generation_record).execute()
+        logger.debug("Saved generation record with ID: %s", generation_record['id'])
+    except Exception as db_error:
+        # The image was generated and returned successfully; only the history entry is lost
+        logger.warning("Could not save generation record: %s", db_error)
+
+
+def _deduct_credits_tables(supabase: Client, user_id: str, action_type: str, credits: int, prompt: str = None, metadata: dict = None):
+    """
+    Fallback for _deduct_credits when the deduct_credits SQL function is missing.
+    The balance update only applies if the balance is still the one read
+    (compare-and-set), so two concurrent requests can't both spend the same
+    credits; a lost race re-reads and tries again.
+    """
+    for _ in range(CREDIT_UPDATE_MAX_ATTEMPTS):
         # 1. Get current balance
-        bal_res = supabase.table("credit_balances").select("*").eq("user_id", user_id).execute()
+        bal_res = supabase.table("credit_balances").select("remaining_credits, used_credits").eq("user_id", user_id).execute()
         if not bal_res.data:
             return  # no balance row = skip (shouldn't happen for registered users)
         
@@ -725,39 +1188,109 @@ def _deduct_credits(supabase: Client, user_id: str, action_type: str, credits: i
                 detail=f"Insufficient credits. Need {credits}, have {remaining}. Upgrade your plan for more credits."
             )
         
-        # 2. Update balance
-        supabase.table("credit_balances").update({
-            "used_credits": balance["used_credits"] + credits,
-            "remaining_credits": remaining - credits,
-            "updated_at": "now()"
-        }).eq("user_id", user_id).execute()
-        
-        # 3. Log credit transaction
-        supabase.table("credit_transactions").insert({
-            "user_id": user_id,
-            "amount": -credits,
-            "type": "generation" if "generat" in action_type else "analysis",
-            "description": f"{action_type}: -{credits} credits",
-            "metadata": metadata or {}
-        }).execute()
-        
-        # 4. Log usage
-        supabase.table("usage_logs").insert({
-            "user_id": user_id,
-            "action_type": action_type,
-            "prompt": prompt,
-            "credits_used": credits,
-            "metadata": metadata or {}
-        }).execute()
+        # 2. Update balance, unless another request changed it since the read
+        update_res = (
+            supabase.table("credit_balances")
+            .update({
+                "used_credits": balance["used_credits"] + credits,
+                "remaining_credits": remaining - credits,
+                "updated_at": "now()"
+            }, count="exact", returning="minimal")
+            .eq("user_id", user_id)
+            .eq("remaining_credits", remaining)
+            .eq("used_credits", balance["used_credits"])
+            .execute()
+        )
+        if update_res.count:
+            break
+    else:
+        raise RuntimeError(f"credit balance for {user_id} kept changing; {credits} credits not deducted")
+    
+    # 3. Log credit transaction
+    supabase.table("credit_transactions").insert({
+        "user_id": user_id,
+        "amount": -credits,
+        "type": "generation" if "generat" in action_type else "analysis",
+        "description": f"{action_type}: -{credits} credits",
+        "metadata": metadata or {}
+    }).execute()
+    
+    # 4. Log usage
+    supabase.table("usage_logs").insert({
+        "user_id": user_id,
+        "action_type": action_type,
+        "prompt": prompt,
+        "credits_used": credits,
+        "metadata": metadata or {}
+    }).execute()
+
+
+def _deduct_credits(supabase: Client, user_id: str, action_type: str, credits: int, prompt: str = None, metadata: dict = None):
+    """
+    Deduct credits from user balance and log the transaction + usage.
+    Served by the deduct_credits SQL function (setup_deduct_credits.sql): one
+    round-trip, one transaction, and no gap between the balance check and update.
+    """
+    global _deduct_function_unavailable
+    try:
+        if _deduct_function_unavailable:
+            _deduct_credits_tables(supabase, user_id, action_type, credits, prompt, metadata)
+            return
+        try:
+            supabase.rpc("deduct_credits", {
+                "p_user_id": user_id,
+                "p_action_type": action_type,
+                "p_credits": credits,
+                "p_prompt": prompt,
+                "p_metadata": metadata or {},
+            }).execute()
+        except PostgrestAPIError as e:
+            if e.message == "INSUFFICIENT_CREDITS":
+                raise HTTPException(
+                    status_code=402,
+                    detail=f"Insufficient credits. Need {credits}, have {e.details}. Upgrade your plan for more credits."
+                )
+            # PGRST202: function not deployed yet; 42501: not granted to our (anon) key
+            if e.code not in ("PGRST202", "42501"):
+                raise
+            _deduct_function_unavailable = True
+            _deduct_credits_tables(supabase, user_id, action_type, credits, prompt, metadata)
     except HTTPException:
         raise
     except Exception as e:
-        print(f"Warning: Credit deduction failed: {e}")
+        logger.warning("Credit deduction failed: %s", e)
         # Don't block the action if credit logging fails
 
+async def _check_credits(supabase: Client, user_id: str, credits: int) -> None:
+    """Raise 402 if the user's balance can't cover `credits`. Users without a balance row pass."""
+    try:
+        res = await execute_async(
+            supabase.table("credit_balances").select("remaining_credits").eq("user_id", user_id)
+        )
+    except Exception as e:
+        logger.warning("Credit check failed: %s", e)
+        return
+    if res.data and res.data[0]["remaining_credits"] < credits:
+        remaining = res.data[0]["remaining_credits"]
+        raise HTTPException(
+            status_code=402,
+            detail=f"Insufficient credits. Need {credits}, have {remaining}. Upgrade your plan for more credits."
+        )
+
+
+def _deduct_credits_after_response(*args, **kwargs):
+    """_deduct_credits for BackgroundTasks, where a 402 can no longer reach the client."""
+    try:
+        _deduct_credits(*args, **kwargs)
+    except HTTPException as e:
+        # Balance was spent by a concurrent request between the check and the deduction
+        logger.warning("Credit deduction after response failed: %s", e.detail)
+
+
 @router.post("/generate")
 async def generate_image(
     request: GenerateImageRequest,
+    background_tasks: BackgroundTasks,
     current_user = Depends(get_current_user_optional),
     supabase: Client = Depends(get_supabase_admin)
 ):
@@ -768,10 +1301,14 @@ async def generate_image(
     Returns the generated image URL from Supabase storage.
     """
     
-    if not GOOGLE_API_KEY:
+    if not settings.GOOGLE_API_KEY:
         raise HTTPException(status_code=500, detail="Google API key not configured")
     
     try:
+        # Fail fast on an empty balance; the deduction itself runs after the response
+        if current_user:
+            await _check_credits(supabase, str(current_user.id), CREDIT_COSTS["generate_image"])
+
         clean_prompt = _sanitize_prompt_for_generation(request.prompt)
         if not clean_prompt:
             clean_prompt = (request.prompt or "").strip()
@@ -784,7 +1321,7 @@ async def generate_image(
             explicit_dataset_ids.append(request.folder_id)
         if request.dataset_id and request.dataset_id not in explicit_dataset_ids:
             explicit_dataset_ids.append(request.dataset_id)
-        resolved_dataset_ids = _resolve_referenced_dataset_ids(
+        resolved_dataset_ids = await _resolve_referenced_dataset_ids(
             supabase=supabase,
             prompt=clean_prompt,
             current_user=current_user,
@@ -794,7 +1331,8 @@ async def generate_image(
         primary_dataset_id = resolved_dataset_ids[0] if resolved_dataset_ids else None
         
         # Resolve style early so retrieval can include it
-        effective_image_style = request.image_style or "photorealistic"
+        requested_style = (request.image_style or "").strip()
+        effective_image_style = _STYLE_ALIASES.get(requested_style.lower(), requested_style) or "photorealistic"
         additional_style_notes = request.style
 
         # 2a. Fetch images from all resolved datasets and select a focused subset
@@ -815,55 +1353,25 @@ async def generate_image(
                 dataset_names = []
                 master_prompts = []
 
-                for ds_id in resolved_dataset_ids:
-                    dataset_res = (
-                        supabase
-                        .table("datasets")
-                        .select("name, master_prompt")
-                        .eq("id", ds_id)
-                        .single()
-                        .execute()
-                    )
-                    if not dataset_res.data:
-                        continue
-
-                    ds_name = dataset_res.data.get("name", "") or ""
-                    ds_master_prompt = dataset_res.data.get("master_prompt", "") or ""
+                # Dataset rows and image lists for all referenced datasets load concurrently
+                for ds_id, dataset_row, ds_images in await _load_datasets_with_images(supabase, resolved_dataset_ids):
+                    ds_name = dataset_row.get("name", "") or ""
+                    ds_master_prompt = dataset_row.get("master_prompt", "") or ""
                     if ds_name:
                         dataset_names.append(ds_name)
                     if ds_master_prompt:
                         master_prompts.append(ds_master_prompt)
 
-                    page_size = 1000
-                    start = 0
-                    while start < MAX_DATASET_IMAGES_FETCH:
-                        end = min(start + page_size - 1, MAX_DATASET_IMAGES_FETCH - 1)
-                        page_res = (
-                            supabase
-                            .table("dataset_images")
-                            .select("image_url, analysis_result, created_at")
-                            .eq("dataset_id", ds_id)
-                            .range(start, end)
-                            .execute()
-                        )
-                        page_data = page_res.data or []
-                        if not page_data:
-                            break
-                        for row in page_data:
-                            row["source_dataset_id"] = ds_id
-                            row["source_dataset_name"] = ds_name
-                        all_images_data.extend(page_data)
-                        if len(page_data) < page_size:
-                            break
-                        start += page_size
+                    for row in ds_images:
+                        row["source_dataset_name"] = ds_name
+                    all_images_data.extend(ds_images)
 
                 if all_images_data:
                     folder_name = ", ".join(dataset_names[:10])
                     dataset_master_prompt = " | ".join(master_prompts[:6])
-                    print(
-                        f"Resolved {len(resolved_dataset_ids)} dataset references "
-                        f"with {len(all_images_data)} total images "
-                        f"(targeting top {reference_target}, hard cap {MODEL_MAX_REFERENCE_IMAGES})"
+                    logger.info(
+                        "Resolved %s dataset references with %s total images (targeting top %s, hard cap %s)",
+                        len(resolved_dataset_ids), len(all_images_data), reference_target, MODEL_MAX_REFERENCE_IMAGES,
                     )
 
                     retrieval_query = _build_relevance_query(
@@ -878,13 +1386,19 @@ async def generate_image(
                         len(all_images_data),
                         max(reference_target, reference_target * HYBRID_CANDIDATE_MULTIPLIER)
                     )
-                    semantic_candidates = _find_relevant_images_semantic(
+                    fresh_embeddings = []
+                    semantic_candidates = await asyncio.to_thread(
+                        _find_relevant_images_semantic,
                         gemini_client=client,
                         prompt=retrieval_query,
                         images_data=all_images_data,
                         max_images=semantic_pool_size,
+                        fresh_embeddings=fresh_embeddings,
+                        supabase=supabase,
                     )
-                    ranked_images = _rerank_images_with_vision(
+                    if fresh_embeddings:
+                        background_tasks.add_task(_store_image_embeddings, supabase, fresh_embeddings)
+                    ranked_images = await _rerank_images_with_vision(
                         gemini_client=client,
                         prompt=retrieval_query,
                         images_data=semantic_candidates,
@@ -892,68 +1406,79 @@ async def generate_image(
                     )
 
                     # Coverage guard: ensure each referenced dataset can contribute
-                    # at least one image when possible.
-                    dataset_counts = {}
-                    for img in ranked_images:
-                        ds = img.get("source_dataset_id")
-                        if ds:
-                            dataset_counts[ds] = dataset_counts.get(ds, 0) + 1
-
-                    for ds_id in resolved_dataset_ids:
-                        if dataset_counts.get(ds_id, 0) > 0:
-                            continue
-                        replacement = next(
-                            (
-                                img for img in semantic_candidates
-                                if img.get("source_dataset_id") == ds_id and img not in ranked_images
-                            ),
-                            None,
+                    # at least one image when possible (only relevant with several).
+                    # Counts come from one pass; membership is by identity (a set of
+                    # id()s) instead of comparing whole image dicts against the list.
+                    if len(resolved_dataset_ids) > 1:
+                        dataset_counts = Counter(
+                            img.get("source_dataset_id") for img in ranked_images if img.get("source_dataset_id")
                         )
-                        if not replacement:
-                            continue
-
-                        if len(ranked_images) < reference_target:
-                            ranked_images.append(replacement)
-                            dataset_counts[ds_id] = dataset_counts.get(ds_id, 0) + 1
-                            continue
-
-                        # If target is full, replace an overrepresented dataset sample.
-                        replace_idx = None
-                        for idx in range(len(ranked_images) - 1, -1, -1):
-                            existing_ds = ranked_images[idx].get("source_dataset_id")
-                            if existing_ds and dataset_counts.get(existing_ds, 0) > 1:
-                                replace_idx = idx
-                                break
-
-                        if replace_idx is None:
-                            continue
-
-                        removed_ds = ranked_images[replace_idx].get("source_dataset_id")
-                        if removed_ds:
-                            dataset_counts[removed_ds] = max(0, dataset_counts.get(removed_ds, 0) - 1)
-                        ranked_images[replace_idx] = replacement
-                        dataset_counts[ds_id] = dataset_counts.get(ds_id, 0) + 1
-
-                    # Download the ranked references
+                        ranked_ids = {id(img) for img in ranked_images}
+
+                        for ds_id in resolved_dataset_ids:
+                            if dataset_counts[ds_id] > 0:
+                                continue
+                            replacement = next(
+                                (
+                                    img for img in semantic_candidates
+                                    if img.get("source_dataset_id") == ds_id and id(img) not in ranked_ids
+                                ),
+                                None,
+                            )
+                            if not replacement:
+                                continue
+
+                            if len(ranked_images) < reference_target:
+                                ranked_images.append(replacement)
+                                ranked_ids.add(id(replacement))
+                                dataset_counts[ds_id] += 1
+                                continue
+
+                            # If target is full, replace an overrepresented dataset sample.
+                            replace_idx = None
+                            for idx in range(len(ranked_images) - 1, -1, -1):
+                                existing_ds = ranked_images[idx].get("source_dataset_id")
+                                if existing_ds and dataset_counts[existing_ds] > 1:
+                                    replace_idx = idx
+                                    break
+
+                            if replace_idx is None:
+                                continue
+
+                            removed = ranked_images[replace_idx]
+                            removed_ds = removed.get("source_dataset_id")
+                            if removed_ds:
+                                dataset_counts[removed_ds] = max(0, dataset_counts[removed_ds] - 1)
+                            ranked_ids.discard(id(removed))
+                            ranked_images[replace_idx] = replacement
+                            ranked_ids.add(id(replacement))
+                            dataset_counts[ds_id] += 1
+
+                    # Download the ranked references concurrently, a few at a time so one
+                    # request can't take over the shared connection pool. Rows pointing at
+                    # the same storage object are fetched and attached once.
+                    ref_candidates = {}
                     for img in ranked_images:
                         if img.get('image_url'):
-                            try:
-                                img_response = requests.get(img['image_url'], timeout=10)
-                                if img_response.status_code == 200:
-                                    pil_image = PILImage.open(io.BytesIO(img_response.content))
-                                    pil_image = _resize_image_if_needed(pil_image)
-                                    reference_images.append(pil_image)
-                                    print(
-                                        f"Selected reference image from '{img.get('source_dataset_name', 'dataset')}' "
-                                        f"({pil_image.size[0]}x{pil_image.size[1]}): {img['image_url']}"
-                                    )
-                            except Exception as img_error:
-                                print(f"Warning: Could not load reference image {img.get('image_url')}: {img_error}")
+                            ref_candidates.setdefault(img['image_url'], img)
+                    download_semaphore = asyncio.Semaphore(REFERENCE_DOWNLOAD_CONCURRENCY)
+                    prepared_refs = await asyncio.gather(
+                        *(_load_reference_image(url, download_semaphore) for url in ref_candidates)
+                    )
+                    for img, prepared in zip(ref_candidates.values(), prepared_refs):
+                        if prepared is None:
+                            continue
+                        image_data, mime_type, (width, height) = prepared
+                        reference_images.append((image_data, mime_type))
+                        logger.debug(
+                            "Selected reference image from '%s' (%sx%s): %s",
+                            img.get('source_dataset_name', 'dataset'), width, height, img['image_url'],
+                        )
                     
-                    print(f"Loaded {len(reference_images)} reference images for generation")
+                    logger.info("Loaded %s reference images for generation", len(reference_images))
                             
             except Exception as e:
-                print(f"Warning: Could not fetch dataset images: {e}")
+                logger.warning("Could not fetch dataset images: %s", e)
                 # Continue anyway - reference images are optional
         
         # 3. Build the prompt — keep it simple, let the images do the work
@@ -966,17 +1491,13 @@ async def generate_image(
             # - clear intent
             # - explicit constraints
             # - output target grounded by references
-            full_prompt = (
-                "Using the provided reference images as visual ground truth, generate one final image. "
-                "Preserve the most important subject identity, composition language, lighting behavior, "
-                "texture/material treatment, and overall color palette from those references. "
-                f"User request: {clean_prompt}. "
-                f"Target style class: {effective_image_style}."
-            )
-            if additional_style_notes:
-                full_prompt += f" Additional style notes: {additional_style_notes}."
+            full_prompt = REFERENCE_PROMPT_TEMPLATE.format_map({
+                "prompt": clean_prompt,
+                "image_style": effective_image_style,
+                "style_notes": f" Additional style notes: {additional_style_notes}." if additional_style_notes else "",
+            })
             
-            print(f"Using reference-image prompt with {len(reference_images)} images")
+            logger.debug("Using reference-image prompt with %s images", len(reference_images))
         else:
             # === PROMPT WITHOUT REFERENCE IMAGES (text-to-image) ===
             style_suffix = ""
@@ -985,28 +1506,15 @@ async def generate_image(
             
             full_prompt = f"{clean_prompt}{style_suffix}".strip()
         
-        print(f"Generating image with Nano Banana Pro (Gemini 3). Prompt: {full_prompt}")
+        logger.debug("Generating image with Nano Banana Pro (Gemini 3). Prompt: %s", full_prompt)
         if reference_images:
-            print(f"Using {len(reference_images)} reference images from dataset")
+            logger.debug("Using %s reference images from dataset", len(reference_images))
         
         # 4. Generate image using Nano Banana Pro (Gemini 3 Pro Image Preview)
         if not client:
              raise HTTPException(status_code=500, detail="Gemini client not initialized")
 
-        # Map aspect ratio from request format (e.g., "1:1") to API format
-        aspect_ratio_map = {
-            "1:1": "1:1",
-            "16:9": "16:9",
-            "9:16": "9:16",
-            "4:3": "4:3",
-            "3:4": "3:4",
-            "2:3": "2:3",
-            "3:2": "3:2",
-            "4:5": "4:5",
-            "5:4": "5:4",
-            "21:9": "21:9"
-        }
-        aspect_ratio = aspect_ratio_map.get(request.aspect_ratio, "1:1")
+        aspect_ratio = request.aspect_ratio if request.aspect_ratio in SUPPORTED_ASPECT_RATIOS else "1:1"
         resolution = "2K"
         
         # Build parts: [prompt, image1, image2, ...] — following Gemini docs pattern
@@ -1014,70 +1522,76 @@ async def generate_image(
         images_to_send = reference_images[:MODEL_MAX_REFERENCE_IMAGES]
         response = None
         
-        for attempt in range(2):
-            # Prompt text first, then reference images (no trailing text)
-            parts = [types.Part.from_text(text=full_prompt)]
-            
-            uploaded_files = []  # Track uploaded files for cleanup
-            
-            if images_to_send:
-                # Use File API to handle multiple images (avoids 20MB payload limit)
+        # One part per reference image, built once: the retry below sends a
+        # prefix of the same list, so nothing is uploaded twice
+        reference_parts = []
+        uploaded_files = []  # Track uploaded files for cleanup
+        
+        if images_to_send:
+            # Use File API to handle multiple images (avoids 20MB payload limit).
+            # Uploads run concurrently, FILE_UPLOAD_CONCURRENCY at a time;
+            # gather keeps the parts in reference order.
+            upload_semaphore = asyncio.Semaphore(FILE_UPLOAD_CONCURRENCY)
+
+            async def upload_reference(image_data: bytes, mime_type: str):
+                async with upload_semaphore:
+                    return await client.aio.files.upload(
+                        file=io.BytesIO(image_data),
+                        config=types.UploadFileConfig(mime_type=mime_type)
+                    )
+
+            logger.debug("Uploading %s reference images to Gemini File API...", len(images_to_send))
+            results = await asyncio.gather(
+                *(upload_reference(image_data, mime_type) for image_data, mime_type in images_to_send),
+                return_exceptions=True,
+            )
+            uploaded_files = [result for result in results if not isinstance(result, BaseException)]
+            upload_errors = [result for result in results if isinstance(result, BaseException)]
+            if not upload_errors:
+                reference_parts = [
+                    types.Part.from_uri(file_uri=uploaded_file.uri, mime_type=uploaded_file.mime_type)
+                    for uploaded_file in uploaded_files
+                ]
+            else:
+                logger.warning("File API upload failed: %s. Falling back to inline bytes.", upload_errors[0])
+                reference_parts = [
+                    types.Part.from_bytes(data=image_data, mime_type=mime_type)
+                    for image_data, mime_type in images_to_send
+                ]
+        
+        try:
+            for attempt in range(2):
+                # Prompt text first, then reference images (no trailing text)
+                parts = [types.Part.from_text(text=full_prompt), *reference_parts[:len(images_to_send)]]
+                contents = [types.Content(role="user", parts=parts)]
+                
                 try:
-                    for ref_img in images_to_send:
-                        ref_img = _ensure_rgb_image(ref_img)
-                        
-                        with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as tf:
-                            ref_img.save(tf.name, format="PNG")
-                            tf_path = tf.name
-                        
-                        try:
-                            print(f"Uploading reference image to Gemini File API...")
-                            uploaded_file = client.files.upload(path=tf_path, config=types.UploadFileConfig(mime_type="image/png"))
-                            uploaded_files.append(uploaded_file)
-                            parts.append(types.Part.from_uri(
-                                file_uri=uploaded_file.uri,
-                                mime_type=uploaded_file.mime_type
-                            ))
-                        finally:
-                            if os.path.exists(tf_path):
-                                os.unlink(tf_path)
-                    
-                except Exception as upload_err:
-                    print(f"File API upload failed: {upload_err}. Falling back to inline bytes.")
-                    parts = [types.Part.from_text(text=full_prompt)]
-                    uploaded_files = []
-                    
-                    for ref_img in images_to_send:
-                        ref_img = _ensure_rgb_image(ref_img)
-                        img_byte_arr = io.BytesIO()
-                        ref_img.save(img_byte_arr, format='PNG')
-                        img_byte_arr.seek(0)
-                        parts.append(types.Part.from_bytes(data=img_byte_arr.read(), mime_type="image/png"))
-            
-            contents = [types.Content(role="user", parts=parts)]
-            
-            try:
-                response = await _generate_with_retry(
-                    client=client,
-                    model='gemini-3-pro-image-preview',
-                    contents=contents,
-                    config=types.GenerateContentConfig(
-                        response_modalities=["IMAGE"],
-                        image_config=types.ImageConfig(
-                            aspect_ratio=aspect_ratio,
-                            image_size=resolution
-                        )
-                    ),
-                )
-                break
-            except APIError as e:
-                err_str = str(e)
-                # 400 INVALID_ARGUMENT often from payload size or image format — retry with fewer images
-                if attempt == 0 and len(images_to_send) > 3 and ("400" in err_str or "INVALID_ARGUMENT" in err_str):
-                    print(f"400 INVALID_ARGUMENT with {len(images_to_send)} images, retrying with top 3...")
-                    images_to_send = images_to_send[:3]
-                else:
-                    raise
+                    response = await _generate_with_retry(
+                        client=client,
+                        model='gemini-3-pro-image-preview',
+                        contents=contents,
+                        config=types.GenerateContentConfig(
+                            response_modalities=["IMAGE"],
+                            image_config=types.ImageConfig(
+                                aspect_ratio=aspect_ratio,
+                                image_size=resolution
+                            )
+                        ),
+                    )
+                    break
+                except APIError as e:
+                    err_str = str(e)
+                    # 400 INVALID_ARGUMENT often from payload size or image format — retry with fewer images
+                    if attempt == 0 and len(images_to_send) > 3 and ("400" in err_str or "INVALID_ARGUMENT" in err_str):
+                        logger.warning("400 INVALID_ARGUMENT with %s images, retrying with top 3...", len(images_to_send))
+                        images_to_send = images_to_send[:3]
+                    else:
+                        raise
+        finally:
+            # The uploads are only needed for this call; delete them rather than
+            # letting them count against the File API quota until they expire
+            if uploaded_files:
+                _spawn_background(_delete_gemini_files(client, uploaded_files))
         
         if response is None:
             raise HTTPException(status_code=500, detail="Image generation failed")
@@ -1093,6 +1607,12 @@ async def generate_image(
         if not image_bytes:
             raise HTTPException(status_code=500, detail="No image generated by Nano Banana")
         
+        # The response (which can also carry interim "thought" images) and the
+        # request parts are no longer needed; drop them so only the final image
+        # stays alive during the upload.
+        reference_images_count = len(images_to_send)
+        del response, contents, parts, reference_parts, images_to_send
+        
         # 6. Upload to Supabase Storage
         file_ext = request.format or "png"
         file_name = f"generated-{uuid.uuid4()}.{file_ext}"
@@ -1100,55 +1620,49 @@ async def generate_image(
         
         # Upload to 'generated-images' bucket (create if doesn't exist)
         try:
-            supabase.storage.from_("generated-images").upload(
-                path=file_path,
-                file=image_bytes,
-                file_options={"content-type": f"image/{file_ext}"}
-            )
+            await upload_storage_object("generated-images", file_path, image_bytes, f"image/{file_ext}")
         except Exception as upload_error:
             # If bucket doesn't exist, try to create it
-            print(f"Upload error: {upload_error}")
+            logger.error("Upload error: %s", upload_error)
             # For now, just re-raise - bucket should be created manually in Supabase dashboard
             raise HTTPException(
                 status_code=500, 
                 detail=f"Failed to upload image to storage. Please ensure 'generated-images' bucket exists in Supabase. Error: {str(upload_error)}"
             )
         
-        # 7. Get public URL
-        public_url = supabase.storage.from_("generated-images").get_public_url(file_path)
+        del image_bytes
         
-        # 8. Save generation record to database with full metadata
-        generation_id = None
-        try:
-            generation_record = {
-                "user_id": current_user.id if current_user else None,
-                "prompt": clean_prompt,
-                "full_prompt": full_prompt,
-                "image_url": public_url,
-                "dataset_id": primary_dataset_id,
-                "environment_id": request.environment_id,
-                "style": request.style,
-                "image_style": effective_image_style,
-                "aspect_ratio": request.aspect_ratio,
-                "quality": request.quality,
-                "format": request.format,
-                "resolution": resolution,
-                "reference_images_count": len(images_to_send),
-                "unique_visual_elements": None
-            }
-            
-            # Insert generation record into database
-            result = supabase.table("generated_images").insert(generation_record).execute()
-            if result.data:
-                generation_id = result.data[0].get('id')
-                print(f"Saved generation record with ID: {generation_id}")
-        except Exception as db_error:
-            print(f"Warning: Could not save generation record: {db_error}")
-            # Continue anyway - the image was generated successfully
+        # 7. Public URL (built locally - it's a fixed template for public buckets)
+        public_url = public_object_url("generated-images", file_path)
+        
+        # 8. Save generation record to database with full metadata.
+        # The id is generated here so the response doesn't wait on the insert,
+        # which runs after the response has been sent.
+        generation_id = str(uuid.uuid4())
+        generation_record = {
+            "id": generation_id,
+            "user_id": current_user.id if current_user else None,
+            "prompt": clean_prompt,
+            "full_prompt": full_prompt,
+            "image_url": public_url,
+            "dataset_id": primary_dataset_id,
+            "environment_id": request.environment_id,
+            "style": request.style,
+            "image_style": effective_image_style,
+            "aspect_ratio": request.aspect_ratio,
+            "quality": request.quality,
+            "format": request.format,
+            "resolution": resolution,
+            "reference_images_count": reference_images_count,
+            "unique_visual_elements": None
+        }
+        background_tasks.add_task(_record_generation, supabase, generation_record)
         
-        # 9. Deduct credits if user is logged in
+        # 9. Deduct credits if user is logged in (after the response is sent;
+        # the balance was checked before generating)
         if current_user:
-            _deduct_credits(
+            background_tasks.add_task(
+                _deduct_credits_after_response,
                 supabase, str(current_user.id),
                 action_type="generate_image",
                 credits=CREDIT_COSTS["generate_image"],
@@ -1171,7 +1685,7 @@ async def generate_image(
             "quality": request.quality,
             "format": request.format,
             "resolution": resolution,
-            "reference_images_count": len(images_to_send),
+            "reference_images_count": reference_images_count,
             "credits_used": CREDIT_COSTS["generate_image"] if current_user else 0
         }
         
@@ -1179,18 +1693,14 @@ async def generate_image(
         # Re-raise HTTP exceptions
         raise
     except ServerError as e:
-        print(f"Image generation failed after retries (Gemini server error): {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Image generation failed after retries (Gemini server error): %s", e)
         raise HTTPException(
             status_code=503,
             detail="Image generation temporarily unavailable. Google's AI service returned a server error after multiple retries. Please try again in a few moments."
         )
     except APIError as e:
         err_str = str(e)
-        print(f"Image generation failed (Gemini API error): {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Image generation failed (Gemini API error): %s", e)
         # 400 INVALID_ARGUMENT: often payload size, image format, or content policy
         if "400" in err_str or "INVALID_ARGUMENT" in err_str:
             detail = (
@@ -1201,15 +1711,14 @@ async def generate_image(
             detail = f"Image generation failed due to an AI service error: {err_str}"
         raise HTTPException(status_code=502, detail=detail)
     except Exception as e:
-        print(f"Image generation error: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Image generation error: %s", e)
         raise HTTPException(status_code=500, detail=f"Image generation failed: {str(e)}")
 
 @router.get("/generated-images")
 async def get_generated_images(
     limit: int = 50,
     offset: int = 0,
+    cursor: str | None = None,
     dataset_id: str = None,
     current_user = Depends(get_current_user_optional),
     supabase: Client = Depends(get_supabase_admin)
@@ -1217,10 +1726,17 @@ async def get_generated_images(
     """
     Retrieve generated images history with all metadata.
     Supports filtering by dataset_id and pagination.
+    Pass the returned next_cursor as ?cursor= to get the next page; it seeks past
+    the previous page instead of skipping rows, so deep pages cost the same as
+    the first. offset still works for older clients.
     Returns: list of generated images with prompts, URLs, and generation details.
     """
+    position = decode_keyset_cursor(cursor) if cursor else None
     try:
-        query = supabase.table("generated_images").select("*")
+        # On the first page, count="exact" makes PostgREST report the total number
+        # of matching rows in the same response, so pagination UIs need no
+        # separate count call
+        query = supabase.table("generated_images").select("*", count="exact" if position is None else None)
         
         # Filter by user if authenticated
         if current_user:
@@ -1231,18 +1747,19 @@ async def get_generated_images(
             query = query.eq("dataset_id", dataset_id)
         
         # Apply pagination and ordering
-        query = query.order("created_at", desc=True).range(offset, offset + limit - 1)
-        
-        result = query.execute()
+        result = await execute_async(keyset_page(query, limit, offset, position))
+        images = result.data
         
         return {
-            "images": result.data,
-            "count": len(result.data),
+            "images": images,
+            "count": len(images),
+            "total": result.count,
             "offset": offset,
-            "limit": limit
+            "limit": limit,
+            "next_cursor": encode_keyset_cursor(images[-1]) if len(images) == limit else None
         }
     except Exception as e:
-        print(f"Error fetching generated images: {e}")
+        logger.error("Error fetching generated images: %s", e)
         raise HTTPException(status_code=500, detail=f"Failed to fetch generated image: {str(e)}")
 
 @router.get("/generated-images/{image_id}")
@@ -1261,7 +1778,7 @@ async def get_generated_image_by_id(
         if current_user:
             query = query.eq("user_id", current_user.id)
         
-        result = query.single().execute()
+        result = await execute_async(query.single())
         
         if not result.data:
             raise HTTPException(status_code=404, detail="Generated image not found")
@@ -1270,11 +1787,242 @@ async def get_generated_image_by_id(
     except HTTPException:
         raise
     except Exception as e:
-        print(f"Error fetching generated image: {e}")
+        logger.error("Error fetching generated image: %s", e)
         raise HTTPException(status_code=500, detail=f"Failed to fetch generated image: {str(e)}")
 
+async def _ensure_dataset_exists(supabase: Client, dataset_id: str, current_user) -> None:
+    """
+    Create the dataset row if it is missing, in one idempotent upsert.
+    An existing dataset is left untouched (ON CONFLICT DO NOTHING).
+    """
+    # user_id is nullable to support anonymous uploads
+    await execute_async(
+        supabase.table("datasets").upsert(
+            {
+                "id": dataset_id,
+                "user_id": current_user.id if current_user else None,
+                "name": "Untitled Dataset"
+            },
+            on_conflict="id",
+            ignore_duplicates=True,
+        )
+    )
+    invalidate_dataset_listing(str(current_user.id) if current_user else None)
+
+def _stamp_dataset_image_rows(rows: list) -> None:
+    """
+    Fill in id and created_at, so inserts can use return=minimal instead of
+    having PostgREST echo every row (and its analysis) back.
+    """
+    created_at = datetime.now(timezone.utc).isoformat()
+    for row in rows:
+        row["id"] = str(uuid.uuid4())
+        row["created_at"] = created_at
+
+async def _insert_dataset_images(supabase: Client, dataset_id: str, rows: list) -> list:
+    """Store analyzed images with one bulk insert. Returns the created rows."""
+    if not rows:
+        return []
+    _stamp_dataset_image_rows(rows)
+    try:
+        await execute_async(supabase.table("dataset_images").insert(rows, returning="minimal"))
+    except Exception as e:
+        logger.error("Error saving %s analyzed images for dataset %s: %s", len(rows), dataset_id, e)
+        return []
+    invalidate_dataset(dataset_id)
+    return rows
+
+async def _commit_dataset_images(
+    supabase: Client, dataset_id: str, rows: list, current_user, action_type: str, prompt: str
+) -> list:
+    """
+    Store analyzed images and charge logged-in users for them in one transaction
+    (the analyze_commit SQL function, setup_analyze_commit.sql). Returns the
+    stored rows. Raises 402, storing nothing, if the balance can't cover them.
+    Falls back to _insert_dataset_images + _deduct_credits until the function exists
+    and is executable by our key.
+    """
+    global _commit_function_unavailable
+    if not rows:
+        return []
+    user_id = str(current_user.id) if current_user else None
+    credits = len(rows) * CREDIT_COSTS["analyze_dataset_per_image"] if user_id else 0
+    metadata = {"dataset_id": dataset_id, "images_analyzed": len(rows)}
+
+    if _commit_function_unavailable:
+        return await _insert_and_deduct_dataset_images(
+            supabase, dataset_id, rows, user_id, action_type, credits, prompt, metadata
+        )
+    _stamp_dataset_image_rows(rows)
+    try:
+        await execute_async(supabase.rpc("analyze_commit", {
+            "p_rows": rows,
+            "p_user_id": user_id,
+            "p_action_type": action_type,
+            "p_credits": credits,
+            "p_prompt": prompt,
+            "p_metadata": metadata,
+        }))
+    except PostgrestAPIError as e:
+        if e.message == "INSUFFICIENT_CREDITS":
+            raise HTTPException(
+                status_code=402,
+                detail=f"Insufficient credits. Need {credits}, have {e.details}. Upgrade your plan for more credits."
+            )
+        # PGRST202: function not deployed yet; 42501: not granted to our (anon) key
+        if e.code not in ("PGRST202", "42501"):
+            logger.error("Error saving %s analyzed images for dataset %s: %s", len(rows), dataset_id, e.message)
+            return []
+        _commit_function_unavailable = True
+        return await _insert_and_deduct_dataset_images(
+            supabase, dataset_id, rows, user_id, action_type, credits, prompt, metadata
+        )
+    except Exception as e:
+        logger.error("Error saving %s analyzed images for dataset %s: %s", len(rows), dataset_id, e)
+        return []
+    invalidate_dataset(dataset_id)
+    return rows
+
+async def _insert_and_deduct_dataset_images(
+    supabase: Client,
+    dataset_id: str,
+    rows: list,
+    user_id: str | None,
+    action_type: str,
+    credits: int,
+    prompt: str,
+    metadata: dict,
+) -> list:
+    """
+    _commit_dataset_images without analyze_commit: check the balance, insert,
+    then deduct. If another request spends the credits in between, the rows
+    just inserted are deleted again before the 402 is raised.
+    """
+    if user_id:
+        await _check_credits(supabase, user_id, credits)
+    results = await _insert_dataset_images(supabase, dataset_id, rows)
+    if user_id and results:
+        try:
+            await asyncio.to_thread(
+                _deduct_credits,
+                supabase, user_id,
+                action_type=action_type,
+                credits=credits,
+                prompt=prompt,
+                metadata=metadata
+            )
+        except HTTPException:
+            try:
+                await execute_async(
+                    supabase.table("dataset_images").delete(returning="minimal").in_("id", [row["id"] for row in results])
+                )
+            except Exception as e:
+                logger.error("Could not remove unpaid images from dataset %s: %s", dataset_id, e)
+            invalidate_dataset(dataset_id)
+            raise
+    return results
+
+def _analysis_cache_key(image_bytes: bytes) -> str:
+    return f"{ANALYSIS_CACHE_VERSION}:{hashlib.sha256(image_bytes).hexdigest()}"
+
+
+def _limit_anonymous_analysis(request: Request, current_user, image_count: int) -> None:
+    """
+    Reject anonymous callers (429) once their IP has used up its free-try images.
+    request.client is the caller behind our proxy (run.py trusts its X-Forwarded-For).
+    A batch no bucket could ever hold is a 400, not a retry-later 429.
+    """
+    if current_user or not image_count:
+        return
+    if image_count > ANONYMOUS_ANALYZE_IMAGES_PER_HOUR:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Anonymous requests can analyze at most {ANONYMOUS_ANALYZE_IMAGES_PER_HOUR} images. Sign in to analyze more images."
+        )
+    client_ip = request.client.host if request.client else "unknown"
+    if not _anonymous_analyze_limiter.try_acquire(client_ip, image_count):
+        raise HTTPException(
+            status_code=429,
+            detail=f"Free analysis limit reached ({ANONYMOUS_ANALYZE_IMAGES_PER_HOUR} images per hour). Sign in to analyze more images."
+        )
+
+
+def _note_analysis_table_error(e: PostgrestAPIError) -> None:
+    global _analysis_table_missing
+    # Table not created yet, or not granted to our (anon) key - stop asking
+    if e.code in ("PGRST205", "42P01", "42501"):
+        _analysis_table_missing = True
+    else:
+        logger.warning("Analysis cache table error: %s", e.message)
+
+
+async def _lookup_cached_analysis(supabase: Client, cache_key: str) -> dict | None:
+    """A previous analysis of the same image bytes, from memory or the image_analysis_cache table."""
+    result = _analysis_cache.get(cache_key)
+    if result is not None or _analysis_table_missing:
+        return result
+    try:
+        res = await execute_async(
+            supabase.table("image_analysis_cache").select("result").eq("hash", cache_key).limit(1)
+        )
+    except PostgrestAPIError as e:
+        _note_analysis_table_error(e)
+        return None
+    except Exception as e:
+        # Only an optimisation - a failed lookup is a cache miss
+        logger.warning("Analysis cache lookup failed: %s", e)
+        return None
+    if not res.data:
+        return None
+    result = res.data[0]["result"]
+    _analysis_cache.set(cache_key, result)
+    return result
+
+
+async def _discard_storage_upload(supabase: Client, upload_task: asyncio.Task, bucket: str, path: str) -> None:
+    """
+    Settle an in-flight upload whose row won't be stored: wait for it (the
+    worker thread can't be cancelled) and delete the object if it was written.
+    """
+    try:
+        await upload_task
+    except Exception:
+        return  # Nothing was written
+    await _remove_storage_objects(supabase, bucket, [path])
+
+
+async def _remove_storage_objects(supabase: Client, bucket: str, paths: list) -> None:
+    """Best-effort delete of uploaded objects whose rows won't be stored."""
+    if not paths:
+        return
+    try:
+        await asyncio.to_thread(supabase.storage.from_(bucket).remove, paths)
+    except Exception as e:
+        logger.warning("Could not delete %s orphaned upload(s) from %s: %s", len(paths), bucket, e)
+
+
+def _store_cached_analyses(supabase: Client, analyses: dict[str, dict]) -> None:
+    """Remember fresh analyses (cache key -> result). Run as a background task."""
+    if not analyses:
+        return
+    for cache_key, result in analyses.items():
+        _analysis_cache.set(cache_key, result)
+    if _analysis_table_missing:
+        return
+    try:
+        supabase.table("image_analysis_cache").upsert(
+            [{"hash": cache_key, "result": result} for cache_key, result in analyses.items()],
+            on_conflict="hash",
+            ignore_duplicates=True,
+            returning="minimal",
+        ).execute()
+    except PostgrestAPIError as e:
+        _note_analysis_table_error(e)
+
 @router.post("/dataset/analyze")
 async def analyze_dataset_images(
+    http_request: Request,
+    background_tasks: BackgroundTasks,
     dataset_id: str = Form(None),
     datasetId: str = Form(None), # Alias for frontend convenience
     files: List[UploadFile] = File(None),
@@ -1283,7 +2031,7 @@ async def analyze_dataset_images(
 ):
     """
     Uploads images to Supabase Storage, analyzes them, and saves results to DB.
-    Allows anonymous users for free tries (frontend managed limit).
+    Allows anonymous users for free tries (a few images per hour per client IP).
     Uses Service Role (admin) to bypass RLS for uploads/inserts.
     """
     # Handle optional/aliased inputs
@@ -1293,145 +2041,145 @@ async def analyze_dataset_images(
     
     # Ensure dataset exists to satisfy FK constraint
     try:
-        # Check if dataset exists
-        ds_check = supabase.table("datasets").select("id").eq("id", actual_dataset_id).execute()
-        if not ds_check.data:
-            # Create it if missing
-            # user_id is now nullable to support anonymous uploads
-            new_dataset = {
-                "id": actual_dataset_id,
-                "user_id": current_user.id if current_user else None,
-                "name": "Untitled Dataset"
-            }
-            supabase.table("datasets").insert(new_dataset).execute()
-            print(f"Created missing dataset: {actual_dataset_id} for {'user ' + current_user.id if current_user else 'anonymous user'}")
+        await _ensure_dataset_exists(supabase, actual_dataset_id, current_user)
     except Exception as e:
-        print(f"Warning: Could not check/create dataset: {e}")
+        logger.warning("Could not check/create dataset: %s", e)
         # Continue anyway - if dataset creation fails, the image insert will fail with FK error
 
     if not files:
          raise HTTPException(status_code=400, detail="No files provided. Please upload at least one image.")
 
+    # Reject oversize uploads before any of them is read into memory
+    for file in files:
+        if file.size is not None and file.size > MAX_UPLOAD_BYTES:
+            raise HTTPException(
+                status_code=413,
+                detail=f"{file.filename} exceeds the {MAX_UPLOAD_BYTES // (1024 * 1024)} MB upload limit"
+            )
+
+    # Free tries are only spent on requests that passed validation
+    _limit_anonymous_analysis(http_request, current_user, len(files))
+
     # If current_user is None, it's an anonymous request.
     # We allow it for free tries.
+    # Logged-in users who can't pay for the batch are turned away before any
+    # upload or Gemini call is made.
+    if current_user:
+        await _check_credits(supabase, str(current_user.id), len(files) * CREDIT_COSTS["analyze_dataset_per_image"])
     
-    results = []
-    
-    for file in files:
+    fresh_analyses = {}  # cache key -> analysis, remembered after the response
+    uploaded_paths = []  # Storage objects written, deleted again if the batch isn't stored
+
+    async def process_upload(file: UploadFile):
         try:
             # 1. Upload to Supabase Storage
+            # One in-memory copy is reused for the storage upload and the Gemini part.
+            # Closing the upload right away frees its spooled buffer instead of keeping
+            # every file of the batch resident until the request ends.
             file_content = await file.read()
+            await file.close()
             file_ext = file.filename.split(".")[-1] if "." in file.filename else "jpg"
             file_path = f"{actual_dataset_id}/{uuid.uuid4()}.{file_ext}"
+            public_url = public_object_url("dataset-images", file_path)
             
-            # Upload file
+            # Upload file while the analysis below runs - neither needs the other.
             # Note: Supabase Python client might raise error if upload fails
-            supabase.storage.from_("dataset-images").upload(
+            upload_task = asyncio.create_task(asyncio.to_thread(
+                supabase.storage.from_("dataset-images").upload,
                 path=file_path,
                 file=file_content,
                 file_options={"content-type": file.content_type}
-            )
-            
-            # Get Public URL
-            # The method returns the URL string directly in recent versions
-            public_url = supabase.storage.from_("dataset-images").get_public_url(file_path)
+            ))
             
             # 2. Analyze with Gemini
             # We use the file content we already have in memory for efficiency.
-            
-            analysis_result = {}
-            if GOOGLE_API_KEY and client:
-                try:
-                    # Use gemini-3-flash-preview for state-of-the-art vision analysis with code execution
-                    # We enable code_execution to allow the model to run code for better reasoning (Agentic Vision)
-                    
-                    prompt = """You are a universal image analysis engine. Analyze this image regardless of its subject matter — it could be architecture, food, fashion, nature, products, people, art, vehicles, technology, or anything else.
-
-Extract the following and return as JSON:
-
-- "description": A rich, detailed description of what the image contains — the subject, composition, setting, notable objects, textures, materials, and any distinctive visual characteristics. Be specific and thorough.
-- "tags": A list of 8-12 specific, descriptive keywords covering: the primary subject, secondary elements, materials/textures, style characteristics, and any unique or distinguishing features. Use concrete nouns and adjectives (e.g., 'Exposed Brick Wall', 'Shallow Depth of Field', 'Velvet Fabric', 'Golden Hour Light', 'Minimalist Layout').
-- "lighting": Specific lighting description — type (natural, artificial, studio, ambient, neon, mixed), direction (front-lit, back-lit, side-lit, overhead), quality (soft, harsh, diffused, dramatic), and color temperature (warm, cool, neutral).
-- "colors": The dominant color palette as a list of 3-6 specific colors or tones (e.g., 'warm amber', 'matte black', 'dusty rose', 'forest green').
-- "vibe": The overall mood, atmosphere, or emotional tone (e.g., 'cozy and intimate', 'clean and professional', 'gritty urban', 'dreamy and ethereal').
-- "theme": The broad category or subject theme of the image (e.g., 'interior design', 'food photography', 'street fashion', 'landscape', 'product shot', 'portrait', 'architecture', 'abstract art').
-- "image_style": Classify the visual/production style of the image into ONE of these categories: 'photorealistic', 'cinematic', 'illustration', 'graphic_design', '3d_render', 'watercolor', 'oil_painting', 'sketch', 'pixel_art', 'anime', 'vintage_film', 'documentary', 'editorial', 'studio_product', 'aerial', 'macro', 'minimalist', 'surreal', 'pop_art', or 'other'. Pick the single best match.
-- "key_elements": A list of 3-5 of the most visually significant and unique elements that define this specific image — the things that make it distinctive and would need to be replicated to recreate a similar image.
-
-Output valid JSON only. No markdown formatting."""
-                    
-                    parts = [
-                        types.Part.from_text(text=prompt),
-                        types.Part.from_bytes(data=file_content, mime_type=file.content_type or "image/jpeg")
-                    ]
+            # The upload is always settled: if anything below fails, the file's
+            # row won't be stored, so the object it wrote is deleted again.
+            try:
+                analysis_result = {}
+                if settings.GOOGLE_API_KEY and client:
+                    # Identical bytes analyzed before (any dataset) reuse that result
+                    cache_key = _analysis_cache_key(file_content)
+                    analysis_result = await _lookup_cached_analysis(supabase, cache_key)
+                if analysis_result is None:
+                    try:
+                        # Use gemini-3-flash-preview for state-of-the-art vision analysis.
+                        # The response is constrained to the ImageAnalysisResult JSON schema.
+                        ai_bytes, ai_mime_type = await asyncio.to_thread(
+                            _prepare_analysis_image, file_content, file.content_type or "image/jpeg"
+                        )
+                        parts = [
+                            ANALYZE_PROMPT_PART,
+                            types.Part.from_bytes(data=ai_bytes, mime_type=ai_mime_type)
+                        ]
                     
-                    response = client.models.generate_content(
-                        model='gemini-3-flash-preview',
-                        contents=[types.Content(role="user", parts=parts)],
-                        config=types.GenerateContentConfig(
-                            tools=[types.Tool(code_execution=types.ToolCodeExecution())]
+                        response = await client.aio.models.generate_content(
+                            model='gemini-3-flash-preview',
+                            contents=[types.Content(role="user", parts=parts)],
+                            config=types.GenerateContentConfig(
+                                response_mime_type="application/json",
+                                response_schema=ImageAnalysisResult
+                            )
                         )
-                    )
                     
-                    # Parse the response
-                    # With code execution, the response might contain multiple parts. 
-                    # We need to extract the text part.
-                    response_text = response.text.strip() if response.text else ""
-                    # Clean up markdown code blocks if present
-                    if response_text.startswith("```json"):
-                        response_text = response_text[7:]
-                    if response_text.startswith("```"):
-                        response_text = response_text[3:]
-                    if response_text.endswith("```"):
-                        response_text = response_text[:-3]
+                        analysis_result = orjson.loads(response.text)
+                        fresh_analyses[cache_key] = analysis_result
                         
-                    try:
-                        analysis_result = json.loads(response_text)
-                    except json.JSONDecodeError:
-                        # Fallback if JSON parsing fails
-                        analysis_result = {
-                            "description": response_text,
-                            "tags": [],
-                            "error": "Failed to parse structured analysis"
-                        }
-                        
-                except Exception as ai_error:
-                    print(f"AI Analysis failed: {ai_error}")
-                    analysis_result = {"error": f"AI analysis failed: {str(ai_error)}"}
+                    except Exception as ai_error:
+                        logger.warning("AI Analysis failed: %s", ai_error)
+                        analysis_result = {"error": f"AI analysis failed: {str(ai_error)}"}
+            except BaseException:
+                await _discard_storage_upload(supabase, upload_task, "dataset-images", file_path)
+                raise
+            
+            # A failed upload skips the file, as before
+            await upload_task
+            uploaded_paths.append(file_path)
             
-            # 3. Store in DB
-            data = {
+            # 3. Row to store - inserted together with the others after gather
+            return {
                 "dataset_id": actual_dataset_id,
                 "image_url": public_url,
                 "analysis_result": analysis_result
             }
-            
-            # Insert and return the created row
-            res = supabase.table("dataset_images").insert(data).execute()
-            if res.data:
-                results.append(res.data[0])
                 
         except Exception as e:
-            print(f"Error processing file {file.filename}: {e}")
-            # We continue processing other files even if one fails
-            continue
+            logger.error("Error processing file %s: %s", file.filename, e)
+            # The other files are still processed
+            return None
+
+    # Files are processed concurrently, ANALYZE_FAST_CONCURRENCY at a time; only
+    # files being worked on are held in memory
+    semaphore = asyncio.Semaphore(ANALYZE_FAST_CONCURRENCY)
+
+    async def sem_process(file: UploadFile):
+        async with semaphore:
+            return await process_upload(file)
 
-    # Deduct credits for analyzed images (1 credit per image)
-    if current_user and results:
-        total_credits = len(results) * CREDIT_COSTS["analyze_dataset_per_image"]
-        _deduct_credits(
-            supabase, str(current_user.id),
+    processed = await asyncio.gather(*[sem_process(file) for file in files])
+    rows = [row for row in processed if row]
+
+    background_tasks.add_task(_store_cached_analyses, supabase, fresh_analyses)
+
+    # Store the rows and deduct credits for them (1 credit per image) together.
+    # On a 402 nothing was stored, so the uploads would be orphaned.
+    try:
+        results = await _commit_dataset_images(
+            supabase, actual_dataset_id, rows, current_user,
             action_type="analyze_dataset",
-            credits=total_credits,
-            prompt=f"Analyzed {len(results)} images in dataset {actual_dataset_id}",
-            metadata={"dataset_id": actual_dataset_id, "images_analyzed": len(results)}
+            prompt=f"Analyzed {len(rows)} images in dataset {actual_dataset_id}",
         )
+    except HTTPException:
+        await _remove_storage_objects(supabase, "dataset-images", uploaded_paths)
+        raise
 
     return {"results": results, "credits_used": len(results) * CREDIT_COSTS["analyze_dataset_per_image"] if current_user else 0}
 
 @router.post("/dataset/analyze-fast")
 async def analyze_dataset_images_fast(
     request: AnalyzeDatasetRequest,
+    http_request: Request,
+    background_tasks: BackgroundTasks,
     current_user = Depends(get_current_user_optional),
     supabase: Client = Depends(get_supabase_admin)
 ):
@@ -1441,125 +2189,128 @@ async def analyze_dataset_images_fast(
     """
     # Ensure dataset exists
     try:
-        ds_check = supabase.table("datasets").select("id").eq("id", request.dataset_id).execute()
-        if not ds_check.data:
-            new_dataset = {
-                "id": request.dataset_id,
-                "user_id": current_user.id if current_user else None,
-                "name": "Untitled Dataset"
-            }
-            supabase.table("datasets").insert(new_dataset).execute()
+        await _ensure_dataset_exists(supabase, request.dataset_id, current_user)
     except Exception as e:
-        print(f"Warning: Could not check/create dataset: {e}")
+        logger.warning("Could not check/create dataset: %s", e)
 
     if not request.image_urls:
          raise HTTPException(status_code=400, detail="No image URLs provided.")
 
-    import asyncio
-    import httpx
+    _limit_anonymous_analysis(http_request, current_user, len(request.image_urls))
 
-    # Reuse HTTP client for better performance
-    http_client = httpx.AsyncClient(timeout=30.0, limits=httpx.Limits(max_connections=50))
-    
-    # Universal analysis prompt — works on any image type (not domain-specific)
-    prompt = """You are a universal image analysis engine. Analyze this image regardless of subject matter — architecture, food, fashion, nature, products, people, art, vehicles, technology, or anything else.
-
-Return JSON with:
-- "tags": 8-12 specific, descriptive keywords covering the subject, materials/textures, style, and unique features. Use concrete terms (e.g., 'Exposed Brick', 'Shallow Depth of Field', 'Velvet Fabric', 'Golden Hour Light').
-- "description": Detailed description of content, composition, setting, notable objects, textures, and distinctive visual characteristics.
-- "lighting": Specific lighting — type (natural/artificial/studio/neon/mixed), direction, quality (soft/harsh/dramatic), and color temperature (warm/cool/neutral).
-- "colors": 3-6 dominant specific colors or tones (e.g., 'warm amber', 'matte black', 'dusty rose').
-- "vibe": Overall mood or emotional tone (e.g., 'cozy and intimate', 'clean and professional', 'gritty urban').
-- "theme": Broad subject category (e.g., 'interior design', 'food photography', 'street fashion', 'portrait', 'product shot', 'landscape').
-- "image_style": ONE of: 'photorealistic', 'cinematic', 'illustration', 'graphic_design', '3d_render', 'watercolor', 'oil_painting', 'sketch', 'pixel_art', 'anime', 'vintage_film', 'documentary', 'editorial', 'studio_product', 'aerial', 'macro', 'minimalist', 'surreal', 'pop_art', or 'other'.
-- "key_elements": 3-5 most visually significant and unique elements that define this image.
+    # Logged-in users who can't pay for the batch are turned away before any download or Gemini call
+    if current_user:
+        await _check_credits(
+            supabase, str(current_user.id), len(request.image_urls) * CREDIT_COSTS["analyze_dataset_per_image"]
+        )
 
-Output valid JSON only."""
+    fresh_analyses = {}  # cache key -> analysis, remembered after the response
+
+    def analyzed_row(image_url, analysis_result):
+        # Row to store - inserted together with the others after gather
+        return {
+            "dataset_id": request.dataset_id,
+            "image_url": image_url,
+            "analysis_result": analysis_result
+        }
 
-    async def process_single_image(image_url):
+    async def process_single_image(image_url, http_client: httpx.AsyncClient):
         try:
-            # 1. Download image
-            resp = await http_client.get(image_url)
+            if not settings.GOOGLE_API_KEY or not client:
+                return {"error": "AI not configured", "image_url": image_url}
+
+            # 1. A URL analyzed before is probed with HEAD first: if its ETag is
+            # unchanged the stored analysis applies and the body isn't downloaded.
+            # A failed probe only means "unknown" - the GET below decides.
+            known = _analysis_url_index.get(image_url)
+            if known is not None:
+                known_etag, cache_key = known
+                try:
+                    head = await http_client.head(image_url, timeout=30.0)
+                except httpx.HTTPError as e:
+                    logger.debug("HEAD probe failed for %s: %s", image_url, e)
+                    head = None
+                if head is not None and head.status_code == 200 and head.headers.get("etag") == known_etag:
+                    cached = await _lookup_cached_analysis(supabase, cache_key)
+                    if cached is not None:
+                        return analyzed_row(image_url, cached)
+
+            # 2. Download image (pooled connections shared by all tasks)
+            resp = await http_client.get(image_url, timeout=30.0)
             if resp.status_code != 200:
                 return {"error": f"Download failed: {resp.status_code}", "image_url": image_url}
             
             file_content = resp.content
             content_type = resp.headers.get("content-type", "image/jpeg")
-
-            # 2. Analyze with Gemini 3.0 Flash (minimal thinking for speed)
-            if not GOOGLE_API_KEY or not client:
-                return {"error": "AI not configured", "image_url": image_url}
+            etag = resp.headers.get("etag")
+
+            # Identical bytes analyzed before (any dataset) reuse that result
+            cache_key = _analysis_cache_key(file_content)
+            cached = await _lookup_cached_analysis(supabase, cache_key)
+            if cached is not None:
+                if etag:
+                    _analysis_url_index.set(image_url, (etag, cache_key))
+                return analyzed_row(image_url, cached)
             
+            # 3. Analyze with Gemini 3.0 Flash (minimal thinking for speed)
             try:
+                ai_bytes, ai_mime_type = await asyncio.to_thread(_prepare_analysis_image, file_content, content_type)
                 parts = [
-                    types.Part.from_text(text=prompt),
-                    types.Part.from_bytes(data=file_content, mime_type=content_type)
+                    ANALYZE_PROMPT_PART,
+                    types.Part.from_bytes(data=ai_bytes, mime_type=ai_mime_type)
                 ]
                 
-                # Use minimal thinking level for maximum speed
-                response = client.models.generate_content(
+                # Use minimal thinking level for maximum speed; the schema constrains
+                # decoding to the ImageAnalysisResult fields, so the JSON always parses
+                response = await client.aio.models.generate_content(
                     model='gemini-3-flash-preview',
                     contents=[types.Content(role="user", parts=parts)],
                     config=types.GenerateContentConfig(
                         response_mime_type="application/json",
+                        response_schema=ImageAnalysisResult,
                         thinking_config=types.ThinkingConfig(thinking_level="minimal")
                     )
                 )
                 
-                analysis_result = json.loads(response.text)
+                analysis_result = orjson.loads(response.text)
+                fresh_analyses[cache_key] = analysis_result
                     
             except Exception as ai_error:
-                print(f"AI Analysis failed for {image_url}: {ai_error}")
+                logger.warning("AI Analysis failed for %s: %s", image_url, ai_error)
                 return {"error": str(ai_error), "image_url": image_url}
             
-            # 3. Store in DB
-            data = {
-                "dataset_id": request.dataset_id,
-                "image_url": image_url,
-                "analysis_result": analysis_result
-            }
-            
-            res = supabase.table("dataset_images").insert(data).execute()
-            return res.data[0] if res.data else None
+            if etag:
+                _analysis_url_index.set(image_url, (etag, cache_key))
+            return analyzed_row(image_url, analysis_result)
                 
         except Exception as e:
-            print(f"Error processing {image_url}: {e}")
+            logger.error("Error processing %s: %s", image_url, e)
             return {"error": str(e), "image_url": image_url}
 
-    try:
-        # Process with higher concurrency (20 at a time for maximum speed)
-        semaphore = asyncio.Semaphore(20)
-        
-        async def sem_process(url):
-            async with semaphore:
-                return await process_single_image(url)
+    # Process with higher concurrency (ANALYZE_FAST_CONCURRENCY at a time for maximum speed)
+    semaphore = asyncio.Semaphore(ANALYZE_FAST_CONCURRENCY)
+    
+    async def sem_process(url):
+        async with semaphore:
+            return await process_single_image(url, async_http_client)
 
-        results = await asyncio.gather(*[sem_process(url) for url in request.image_urls])
-        
-        # Filter out error results
-        valid_results = [r for r in results if r and "error" not in r]
-        
-        # Deduct credits for successfully analyzed images
-        if current_user and valid_results:
-            total_credits = len(valid_results) * CREDIT_COSTS["analyze_dataset_per_image"]
-            _deduct_credits(
-                supabase, str(current_user.id),
-                action_type="analyze_dataset_fast",
-                credits=total_credits,
-                prompt=f"Fast-analyzed {len(valid_results)} images in dataset {request.dataset_id}",
-                metadata={"dataset_id": request.dataset_id, "images_analyzed": len(valid_results)}
-            )
-        
-        return {
-            "results": valid_results, 
-            "total_processed": len(request.image_urls), 
-            "successful": len(valid_results),
-            "credits_used": len(valid_results) * CREDIT_COSTS["analyze_dataset_per_image"] if current_user else 0
-        }
+    results = await asyncio.gather(*[sem_process(url) for url in request.image_urls])
+    
+    # Filter out error results; store the rest and deduct credits for them together
+    rows = [r for r in results if r and "error" not in r]
+    background_tasks.add_task(_store_cached_analyses, supabase, fresh_analyses)
+    valid_results = await _commit_dataset_images(
+        supabase, request.dataset_id, rows, current_user,
+        action_type="analyze_dataset_fast",
+        prompt=f"Fast-analyzed {len(rows)} images in dataset {request.dataset_id}",
+    )
     
-    finally:
-        # Clean up HTTP client
-        await http_client.aclose()
+    return {
+        "results": valid_results, 
+        "total_processed": len(request.image_urls), 
+        "successful": len(valid_results),
+        "credits_used": len(valid_results) * CREDIT_COSTS["analyze_dataset_per_image"] if current_user else 0
+    }
 
 @router.get("/dataset/{dataset_id}/images")
 async def get_dataset_images(
@@ -1572,7 +2323,12 @@ async def get_dataset_images(
     """
     try:
         # Fetch images from the database
-        res = supabase.table("dataset_images").select("*").eq("dataset_id", dataset_id).execute()
+        # Explicit columns keep the stored embedding vectors out of the response
+        res = await execute_async(
+            supabase.table("dataset_images")
+            .select("id, dataset_id, image_url, analysis_result, created_at")
+            .eq("dataset_id", dataset_id)
+        )
         
         if not res.data:
             return {"images": []}
@@ -1601,26 +2357,25 @@ async def update_dataset_training_status(
         )
     
     try:
-        # Check if dataset exists
-        ds_check = supabase.table("datasets").select("id, user_id").eq("id", dataset_id).execute()
-        
-        if not ds_check.data:
-            raise HTTPException(status_code=404, detail="Dataset not found")
-        
-        dataset = ds_check.data[0]
+        # Update the training status in one statement. Logged-in users may only
+        # update their own (or unowned) datasets, so ownership is part of the filter.
+        update_query = (
+            supabase.table("datasets")
+            .update({"training_status": training_status}, returning="minimal", count="exact")
+            .eq("id", dataset_id)
+        )
+        if current_user:
+            update_query = update_query.or_(f"user_id.is.null,user_id.eq.{current_user.id_str}")
+        update_res = await execute_async(update_query)
+        invalidate_dataset(dataset_id)
         
-        # Optional: Verify ownership if user is logged in
-        if current_user and dataset.get("user_id") and dataset["user_id"] != current_user.id:
+        if not update_res.count:
+            # Nothing matched - find out why, for the error (the rare path)
+            ds_check = await execute_async(supabase.table("datasets").select("id").eq("id", dataset_id))
+            if not ds_check.data:
+                raise HTTPException(status_code=404, detail="Dataset not found")
             raise HTTPException(status_code=403, detail="You don't have permission to update this dataset")
         
-        # Update the training status
-        update_res = supabase.table("datasets").update({
-            "training_status": training_status
-        }).eq("id", dataset_id).execute()
-        
-        if not update_res.data:
-            raise HTTPException(status_code=500, detail="Failed to update training status")
-        
         return {
             "success": True,
             "dataset_id": dataset_id,
@@ -1631,7 +2386,7 @@ async def update_dataset_training_status(
     except HTTPException:
         raise
     except Exception as e:
-        print(f"Error updating training status: {e}")
+        logger.error("Error updating training status: %s", e)
         raise HTTPException(status_code=500, detail=f"Failed to update training status: {str(e)}")
 
 @router.post("/analyze")
@@ -1,9 +1,10 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from app.schemas import UserSignup, UserLogin
 from app.dependencies import get_supabase
+from app.responses import ORJSONResponse
 from supabase import Client
 
-router = APIRouter(prefix="/auth", tags=["Auth"])
+router = APIRouter(prefix="/auth", tags=["Auth"], default_response_class=ORJSONResponse)
 
 @router.post("/signup")
 def signup(user: UserSignup, supabase: Client = Depends(get_supabase)):
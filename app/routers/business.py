@@ -11,7 +11,7 @@ def get_business_profile(
     supabase: Client = Depends(get_supabase)
 ):
     try:
-        res = supabase.table("business_profiles").select("*").eq("id", current_user.id).single().execute()
+        res = supabase.table("business_profiles").select("*").eq("id", current_user.id_str).single().execute()
         if not res.data:
             raise HTTPException(status_code=404, detail="Business profile not found")
         return res.data
@@ -25,8 +25,8 @@ def create_or_update_business_profile(
     supabase: Client = Depends(get_supabase)
 ):
     try:
-        data = profile.dict(exclude_unset=True)
-        data["id"] = current_user.id
+        data = profile.model_dump(exclude_unset=True, mode="json")
+        data["id"] = current_user.id_str
         
         # Upsert (insert or update)
         res = supabase.table("business_profiles").upsert(data).execute()
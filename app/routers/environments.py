@@ -1,5 +1,6 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from supabase import Client
+from app.cache import invalidate_dataset, invalidate_dataset_listing
 from app.dependencies import get_current_user, get_supabase
 from app.schemas import (
     EnvironmentCreate, EnvironmentUpdate, EnvironmentResponse,
@@ -97,6 +98,7 @@ def create_environment(
             "name": clean_name,
             "user_id": str(current_user.id)
         }).execute()
+        invalidate_dataset_listing(str(current_user.id))
         if not res.data:
             raise HTTPException(status_code=500, detail="Failed to create environment")
         return res.data[0]
@@ -131,6 +133,7 @@ def update_environment(
             .eq("id", environment_id) \
             .eq("user_id", str(current_user.id)) \
             .execute()
+        invalidate_dataset_listing(str(current_user.id))
         if not res.data:
             raise HTTPException(status_code=404, detail="Environment not found or not owned by you")
         return res.data[0]
@@ -166,6 +169,7 @@ def delete_environment(
             .eq("id", environment_id) \
             .eq("user_id", str(current_user.id)) \
             .execute()
+        invalidate_dataset_listing(str(current_user.id))
         return {"success": True}
     except HTTPException:
         raise
@@ -283,6 +287,8 @@ def update_folder(
             .eq("id", folder_id) \
             .eq("user_id", str(current_user.id)) \
             .execute()
+        invalidate_dataset(folder_id)
+        invalidate_dataset_listing(str(current_user.id))
         if not res.data:
             raise HTTPException(status_code=404, detail="Folder not found or not owned by you")
         return res.data[0]
@@ -339,6 +345,8 @@ def delete_folder(
             .eq("id", folder_id) \
             .eq("user_id", str(current_user.id)) \
             .execute()
+        invalidate_dataset(folder_id)
+        invalidate_dataset_listing(str(current_user.id))
         return {"success": True}
     except HTTPException:
         raise
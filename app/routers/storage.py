@@ -1,11 +1,12 @@
 from fastapi import APIRouter, UploadFile, File, Depends, HTTPException, Form
 from typing import List
-from app.dependencies import get_supabase, get_current_user, get_current_user_optional, get_supabase_admin
+from app.dependencies import get_supabase, get_current_user, get_current_user_optional, get_supabase_admin, public_object_url
+from app.responses import ORJSONResponse
 from app.config import GCS_BUCKET_NAME
 from supabase import Client
 import uuid
 
-router = APIRouter(prefix="/storage", tags=["Storage"])
+router = APIRouter(prefix="/storage", tags=["Storage"], default_response_class=ORJSONResponse)
 
 BUCKET_NAME = "dataset-images"  # Use the same bucket as the analyze endpoint
 
@@ -37,8 +38,8 @@ async def upload_file(
             file_options={"content-type": file.content_type}
         )
         
-        # Get public URL
-        public_url = supabase.storage.from_(BUCKET_NAME).get_public_url(file_path)
+        # Public URLs follow a fixed template - no need to ask the storage client
+        public_url = public_object_url(BUCKET_NAME, file_path)
         
         return {"file_path": file_path, "public_url": public_url}
     except Exception as e:
@@ -74,8 +75,8 @@ async def upload_multiple_files(
                 file_options={"content-type": file.content_type}
             )
             
-            # Get public URL
-            public_url = supabase.storage.from_(BUCKET_NAME).get_public_url(file_path)
+            # Public URLs follow a fixed template - no need to ask the storage client
+            public_url = public_object_url(BUCKET_NAME, file_path)
             
             uploaded_files.append({
                 "file_path": file_path,
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, EmailStr, ConfigDict
-from typing import Optional, Any, List
+from typing import Optional, Any, List, Literal
 from datetime import datetime
 
 class UserSignup(BaseModel):
@@ -65,6 +65,25 @@ class AnalyzeDatasetRequest(BaseModel):
     dataset_id: str
     image_urls: List[str]
 
+# Style classes the dataset analysis assigns (constrained in the Gemini response schema)
+ImageStyle = Literal[
+    "photorealistic", "cinematic", "illustration", "graphic_design", "3d_render",
+    "watercolor", "oil_painting", "sketch", "pixel_art", "anime", "vintage_film",
+    "documentary", "editorial", "studio_product", "aerial", "macro", "minimalist",
+    "surreal", "pop_art", "other",
+]
+
+class ImageAnalysisResult(BaseModel):
+    """Structured output schema for Gemini dataset image analysis."""
+    description: str
+    tags: List[str]
+    lighting: str
+    colors: List[str]
+    vibe: str
+    theme: str
+    image_style: ImageStyle
+    key_elements: List[str]
+
 class UpdateDatasetTrainingStatusRequest(BaseModel):
     dataset_id: str
     training_status: str  # "trained" or "not_trained"
@@ -0,0 +1,24 @@
+# Production entry point: python run.py
+# Runs uvicorn on uvloop (libuv event loop) with the httptools HTTP parser,
+# both C-accelerated and shipped with uvicorn[standard].
+# PORT, HOST and WEB_CONCURRENCY (worker processes) come from the environment.
+# X-Forwarded-For is honoured only from FORWARDED_ALLOW_IPS (default: loopback
+# and the private ranges a platform load balancer connects from), so
+# request.client is the real caller for the per-IP anonymous analyze limit.
+import os
+
+import uvicorn
+
+if __name__ == "__main__":
+    uvicorn.run(
+        "app.main:app",
+        host=os.environ.get("HOST", "0.0.0.0"),
+        port=int(os.environ.get("PORT", "8000")),
+        workers=int(os.environ.get("WEB_CONCURRENCY", "1")),
+        loop="uvloop",
+        http="httptools",
+        proxy_headers=True,
+        forwarded_allow_ips=os.environ.get(
+            "FORWARDED_ALLOW_IPS", "127.0.0.1,10.0.0.0/8,172.16.0.0/12,192.168.0.0/16"
+        ),
+    )
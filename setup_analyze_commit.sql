@@ -0,0 +1,42 @@
+-- Commit function used by the dataset analyze endpoints (_commit_dataset_images)
+-- Run this in your Supabase SQL Editor, after setup_deduct_credits.sql
+
+-- Stores a batch of analyzed dataset images and charges the user for them in
+-- one transaction: one PostgREST round-trip instead of an insert followed by a
+-- separate deduction, and no images are kept without being paid for. When the
+-- balance can't cover the batch, deduct_credits raises INSUFFICIENT_CREDITS
+-- and the inserted rows are rolled back with it.
+-- Until this function exists the API falls back to the insert + deduct_credits calls.
+-- It writes rows and charges any user id, so only the service role may call it
+-- (see setup_deduct_credits.sql).
+
+CREATE OR REPLACE FUNCTION public.analyze_commit(
+    p_rows jsonb,
+    p_user_id uuid DEFAULT NULL,
+    p_action_type text DEFAULT 'analyze_dataset',
+    p_credits integer DEFAULT 0,
+    p_prompt text DEFAULT NULL,
+    p_metadata jsonb DEFAULT '{}'::jsonb
+)
+RETURNS integer
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_inserted integer;
+BEGIN
+    INSERT INTO dataset_images (id, dataset_id, image_url, analysis_result, created_at)
+    SELECT id, dataset_id, image_url, analysis_result, created_at
+    FROM jsonb_populate_recordset(NULL::dataset_images, p_rows);
+    GET DIAGNOSTICS v_inserted = ROW_COUNT;
+
+    -- Anonymous uploads (no user) are free
+    IF p_user_id IS NOT NULL AND p_credits > 0 THEN
+        PERFORM public.deduct_credits(p_user_id, p_action_type, p_credits, p_prompt, p_metadata);
+    END IF;
+
+    RETURN v_inserted;
+END;
+$$;
+
+REVOKE EXECUTE ON FUNCTION public.analyze_commit(jsonb, uuid, text, integer, text, jsonb) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION public.analyze_commit(jsonb, uuid, text, integer, text, jsonb) TO service_role;
@@ -0,0 +1,47 @@
+-- Stored image embeddings used by /ai/generate (_find_relevant_images_semantic)
+-- Run this in your Supabase SQL Editor
+
+-- Each analyzed dataset image keeps the Gemini embedding of its analysis text,
+-- so generating from a dataset only embeds the prompt instead of re-embedding
+-- every image on every request. embedding_hash identifies the text, model and
+-- dimensions an embedding was computed from; when any of them changes the
+-- image is embedded again and the row is updated.
+-- Until these columns exist the API embeds every image on each request.
+
+CREATE EXTENSION IF NOT EXISTS vector;
+
+ALTER TABLE public.dataset_images
+    ADD COLUMN IF NOT EXISTS embedding vector(768),
+    ADD COLUMN IF NOT EXISTS embedding_hash text;
+
+-- Ranking: the images of the given datasets whose stored embedding is closest
+-- to the prompt embedding (cosine), best first. The API sends the prompt
+-- vector and gets back only the top matches, instead of pulling every image's
+-- vector into Python. Until this function exists the API ranks in process.
+CREATE OR REPLACE FUNCTION public.match_dataset_images(
+    query_embedding vector(768),
+    dataset_ids uuid[],
+    match_count integer
+)
+RETURNS TABLE (id uuid, dataset_id uuid, similarity double precision)
+LANGUAGE sql STABLE
+AS $$
+    SELECT di.id, di.dataset_id, 1 - (di.embedding <=> query_embedding) AS similarity
+    FROM public.dataset_images di
+    WHERE di.dataset_id = ANY(dataset_ids)
+      AND di.embedding IS NOT NULL
+    ORDER BY di.embedding <=> query_embedding
+    LIMIT match_count;
+$$;
+
+GRANT EXECUTE ON FUNCTION public.match_dataset_images(vector, uuid[], integer) TO anon, authenticated, service_role;
+
+-- The ranking must be exact: the API merges it with scores computed in process
+-- and relies on getting the true top match_count rows. The dataset_id index
+-- narrows the scan to a few folders' images, which are then sorted exactly.
+-- No HNSW index: its approximate scan, filtered by dataset_id afterwards, can
+-- return fewer rows than asked for.
+CREATE INDEX IF NOT EXISTS dataset_images_dataset_id_idx
+    ON public.dataset_images (dataset_id);
+
+DROP INDEX IF EXISTS public.dataset_images_embedding_hnsw_idx;
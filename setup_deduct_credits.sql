@@ -0,0 +1,63 @@
+-- Credit deduction function used by the AI endpoints (_deduct_credits)
+-- Run this in your Supabase SQL Editor
+
+-- Checks and updates the balance and writes the credit transaction and usage
+-- log in one transaction, so the API needs a single PostgREST round-trip
+-- instead of four and two concurrent requests can't both spend the same credits.
+-- Until this function exists the API falls back to the per-table queries.
+-- It takes any user id, so only the service role may call it: the API uses it
+-- when SUPABASE_SERVICE_ROLE_KEY_PROD is set and falls back otherwise.
+
+CREATE OR REPLACE FUNCTION public.deduct_credits(
+    p_user_id uuid,
+    p_action_type text,
+    p_credits integer,
+    p_prompt text DEFAULT NULL,
+    p_metadata jsonb DEFAULT '{}'::jsonb
+)
+RETURNS jsonb
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_remaining integer;
+BEGIN
+    UPDATE credit_balances
+    SET used_credits = used_credits + p_credits,
+        remaining_credits = remaining_credits - p_credits,
+        updated_at = now()
+    WHERE user_id = p_user_id
+      AND remaining_credits >= p_credits
+    RETURNING remaining_credits INTO v_remaining;
+
+    IF NOT FOUND THEN
+        SELECT remaining_credits INTO v_remaining
+        FROM credit_balances
+        WHERE user_id = p_user_id;
+
+        IF NOT FOUND THEN
+            -- No balance row: nothing to deduct (shouldn't happen for registered users)
+            RETURN NULL;
+        END IF;
+
+        -- The API maps this to HTTP 402; DETAIL carries the current balance
+        RAISE EXCEPTION 'INSUFFICIENT_CREDITS' USING DETAIL = v_remaining::text;
+    END IF;
+
+    INSERT INTO credit_transactions (user_id, amount, type, description, metadata)
+    VALUES (
+        p_user_id,
+        -p_credits,
+        CASE WHEN p_action_type LIKE '%generat%' THEN 'generation' ELSE 'analysis' END,
+        p_action_type || ': -' || p_credits || ' credits',
+        COALESCE(p_metadata, '{}'::jsonb)
+    );
+
+    INSERT INTO usage_logs (user_id, action_type, prompt, credits_used, metadata)
+    VALUES (p_user_id, p_action_type, p_prompt, p_credits, COALESCE(p_metadata, '{}'::jsonb));
+
+    RETURN jsonb_build_object('remaining_credits', v_remaining);
+END;
+$$;
+
+REVOKE EXECUTE ON FUNCTION public.deduct_credits(uuid, text, integer, text, jsonb) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION public.deduct_credits(uuid, text, integer, text, jsonb) TO service_role;
@@ -0,0 +1,25 @@
+-- Indexes for GET /ai/generated-images (generation history)
+-- Run this in your Supabase SQL Editor
+
+-- The endpoint filters by user_id (and optionally dataset_id) and returns the
+-- newest rows first. With these indexes Postgres walks the matching index range
+-- in created_at order and stops after one page, instead of scanning and sorting
+-- every matching row on each request. id is the tie-breaker of the keyset
+-- cursor (?cursor=), so seeking past the previous page is an index range too.
+-- (Run each statement separately with CONCURRENTLY on a busy production table;
+-- the SQL Editor wraps a multi-statement script in one transaction.)
+
+-- History for a user
+CREATE INDEX IF NOT EXISTS generated_images_user_created_idx
+    ON public.generated_images (user_id, created_at DESC, id DESC);
+
+-- History for a user within one dataset (?dataset_id=)
+CREATE INDEX IF NOT EXISTS generated_images_user_dataset_created_idx
+    ON public.generated_images (user_id, dataset_id, created_at DESC, id DESC);
+
+-- Requests without a user (no user_id filter), with and without ?dataset_id=
+CREATE INDEX IF NOT EXISTS generated_images_dataset_created_idx
+    ON public.generated_images (dataset_id, created_at DESC, id DESC);
+
+CREATE INDEX IF NOT EXISTS generated_images_created_idx
+    ON public.generated_images (created_at DESC, id DESC);
@@ -0,0 +1,20 @@
+-- Analysis cache used by the dataset analyze endpoints (_lookup_cached_analysis)
+-- Run this in your Supabase SQL Editor
+
+-- Stores one Gemini analysis per distinct image, keyed by "<version>:<sha256 of
+-- the image bytes>", so re-uploads and catalog images shared across datasets
+-- are analyzed once. The version prefix changes whenever the analysis prompt
+-- does, which retires old entries without deleting anything.
+-- Until this table exists, or while the API runs with the anon key instead of
+-- SUPABASE_SERVICE_ROLE_KEY_PROD, the API caches analyses in process only.
+
+CREATE TABLE IF NOT EXISTS public.image_analysis_cache (
+    hash text PRIMARY KEY,
+    result jsonb NOT NULL,
+    created_at timestamptz NOT NULL DEFAULT now()
+);
+
+-- Only the service role (the analyze endpoints use the admin client) reads or
+-- writes it. RLS stays off like on the other app tables; access is by grant.
+REVOKE ALL ON TABLE public.image_analysis_cache FROM PUBLIC, anon, authenticated;
+GRANT SELECT, INSERT, UPDATE, DELETE ON TABLE public.image_analysis_cache TO service_role;
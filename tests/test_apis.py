@@ -21,6 +21,7 @@ mock_supabase.auth.sign_in_with_password.return_value = {"session": {"access_tok
 # Mock User
 mock_user = MagicMock()
 mock_user.id = "test-user-id"
+mock_user.id_str = "test-user-id"
 
 # Dependency Overrides
 def override_get_supabase():
@@ -89,3 +90,300 @@ def test_get_dataset_images():
     assert "images" in data
     assert len(data["images"]) == 1
     assert data["images"][0]["id"] == "img1"
+
+def test_token_verification_is_cached():
+    import asyncio
+    import time
+    import jwt
+    from app.dependencies import _verify_token, _verified_user_cache
+
+    _verified_user_cache.clear()
+    auth_client = MagicMock()
+    auth_client.auth.get_user.return_value.user = mock_user
+    token = jwt.encode({"sub": "test-user-id", "exp": int(time.time()) + 3600}, "secret")
+
+    user = asyncio.run(_verify_token(token, auth_client))
+    assert user.id_str == "test-user-id"
+    assert asyncio.run(_verify_token(token, auth_client)) is user
+    assert auth_client.auth.get_user.call_count == 1
+
+def test_expired_token_rejected_without_network_call():
+    import time
+    import jwt
+
+    token = jwt.encode({"sub": "test-user-id", "exp": int(time.time()) - 10}, "secret")
+    saved = app.dependency_overrides.pop(get_current_user)
+    try:
+        response = client.get("/users/me", headers={"Authorization": f"Bearer {token}"})
+    finally:
+        app.dependency_overrides[get_current_user] = saved
+    assert response.status_code == 401
+    assert "expired" in response.json()["detail"]
+    mock_supabase.auth.get_user.assert_not_called()
+
+def test_token_verified_locally_with_jwt_secret():
+    import asyncio
+    import time
+    import jwt
+    import dataclasses
+    import app.dependencies as deps
+
+    token = jwt.encode(
+        {"sub": "local-user-id", "email": "a@b.co", "aud": "authenticated", "exp": int(time.time()) + 3600},
+        "jwt-secret",
+    )
+    local_settings = dataclasses.replace(deps.settings, SUPABASE_JWT_SECRET="jwt-secret")
+    with patch.object(deps, "settings", local_settings):
+        user = asyncio.run(deps._verify_token(token, MagicMock()))
+        # A token the secret can't verify is left to Supabase, which rejects it
+        forged = jwt.encode({"sub": "x", "aud": "authenticated"}, "wrong-secret")
+        auth_client = MagicMock()
+        auth_client.auth.get_user.return_value.user = None
+        assert asyncio.run(deps._verify_token(forged, auth_client)) is None
+        assert auth_client.auth.get_user.call_count == 1
+    assert user.id_str == "local-user-id"
+    assert user.email == "a@b.co"
+
+def test_token_revalidation_only_revokes_on_auth_rejection():
+    import asyncio
+    from supabase_auth.errors import AuthApiError
+    import app.dependencies as deps
+
+    for status_code, revoked in ((503, False), (429, False), (401, True)):
+        deps._revoked_tokens.clear()
+        auth_client = MagicMock()
+        auth_client.auth.get_user.side_effect = AuthApiError("error", status_code, None)
+        asyncio.run(deps._revalidate_token("token", b"key", None, auth_client))
+        assert bool(deps._revoked_tokens.get(b"key")) is revoked
+
+def test_commit_dataset_images_insufficient_credits():
+    import asyncio
+    import pytest
+    from fastapi import HTTPException
+    from postgrest.exceptions import APIError
+    import app.routers.ai as ai
+
+    supabase = MagicMock()
+    supabase.rpc.return_value.execute.side_effect = APIError(
+        {"message": "INSUFFICIENT_CREDITS", "code": "P0001", "details": "0"}
+    )
+    rows = [{"dataset_id": "ds", "image_url": "u", "analysis_result": {}}]
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(ai._commit_dataset_images(supabase, "ds", rows, mock_user, "analyze_dataset", "p"))
+    assert exc.value.status_code == 402
+    supabase.table.assert_not_called()
+
+    # Without analyze_commit, rows inserted before a lost credit race are removed again
+    ai._commit_function_unavailable = True
+    ai._deduct_function_unavailable = True
+    try:
+        supabase = MagicMock()
+        supabase.table.return_value.select.return_value.eq.return_value.execute.return_value.data = [
+            {"remaining_credits": 5, "used_credits": 0}
+        ]
+        with patch.object(ai, "_deduct_credits", side_effect=HTTPException(status_code=402)):
+            with pytest.raises(HTTPException):
+                asyncio.run(ai._commit_dataset_images(supabase, "ds", rows, mock_user, "analyze_dataset", "p"))
+        delete = supabase.table.return_value.delete.return_value.in_
+        delete.assert_called_once_with("id", [rows[0]["id"]])
+    finally:
+        ai._commit_function_unavailable = False
+        ai._deduct_function_unavailable = False
+
+def test_analysis_cache_table_denied_stops_queries():
+    import asyncio
+    from postgrest.exceptions import APIError
+    import app.routers.ai as ai
+
+    supabase = MagicMock()
+    supabase.table.return_value.select.return_value.eq.return_value.limit.return_value.execute.side_effect = APIError(
+        {"message": "permission denied for table image_analysis_cache", "code": "42501"}
+    )
+    try:
+        assert asyncio.run(ai._lookup_cached_analysis(supabase, "v:missing")) is None
+        assert ai._analysis_table_missing
+        supabase.table.reset_mock()
+        assert asyncio.run(ai._lookup_cached_analysis(supabase, "v:other")) is None
+        supabase.table.assert_not_called()
+    finally:
+        ai._analysis_table_missing = False
+
+def test_anonymous_analysis_limiter():
+    import pytest
+    from fastapi import HTTPException
+    import app.routers.ai as ai
+    from app.cache import TokenBucketLimiter
+
+    limiter = TokenBucketLimiter(capacity=3, refill_per_second=1.0)
+    with patch("app.cache.time.monotonic", return_value=100.0):
+        assert limiter.try_acquire("1.2.3.4", 3)
+        assert not limiter.try_acquire("1.2.3.4", 1)
+        assert limiter.try_acquire("5.6.7.8", 1)  # Buckets are per key
+    with patch("app.cache.time.monotonic", return_value=102.0):
+        assert limiter.try_acquire("1.2.3.4", 2)  # Refilled 2 tokens
+        assert not limiter.try_acquire("1.2.3.4", 1)
+
+    request = MagicMock()
+    request.client.host = "9.9.9.9"
+    with pytest.raises(HTTPException) as exc:
+        ai._limit_anonymous_analysis(request, None, ai.ANONYMOUS_ANALYZE_IMAGES_PER_HOUR + 1)
+    assert exc.value.status_code == 400
+    ai._limit_anonymous_analysis(request, mock_user, ai.ANONYMOUS_ANALYZE_IMAGES_PER_HOUR + 1)  # Signed in: no limit
+
+def test_usage_history_cursor_pagination():
+    from app.dependencies import encode_keyset_cursor, decode_keyset_cursor
+
+    rows = [
+        {"id": "b", "user_id": "test-user-id", "action_type": "generate_image", "credits_used": 1,
+         "created_at": "2026-01-01T00:00:00+00:00"},
+        {"id": "a", "user_id": "test-user-id", "action_type": "generate_image", "credits_used": 1,
+         "created_at": "2026-01-01T00:00:00+00:00"},
+    ]
+    ordered = mock_supabase.table.return_value.select.return_value.eq.return_value.order.return_value.order.return_value
+    ordered.range.return_value.execute.return_value.data = rows
+
+    # Offset pages keep the plain list shape; a full page hands out a cursor
+    response = client.get("/account/usage?limit=2")
+    assert response.status_code == 200
+    assert [row["id"] for row in response.json()] == ["b", "a"]
+    cursor = response.headers["X-Next-Cursor"]
+    assert decode_keyset_cursor(cursor) == ("2026-01-01T00:00:00+00:00", "a")
+
+    # The next page seeks past (created_at, id), so rows sharing the boundary timestamp aren't skipped
+    ordered.or_.return_value.limit.return_value.execute.return_value.data = rows[1:]
+    response = client.get(f"/account/usage?limit=2&cursor={cursor}")
+    assert response.status_code == 200
+    ordered.or_.assert_called_with(
+        'created_at.lt."2026-01-01T00:00:00+00:00",'
+        'and(created_at.eq."2026-01-01T00:00:00+00:00",id.lt."a")'
+    )
+    assert "X-Next-Cursor" not in response.headers
+
+    assert client.get("/account/usage?cursor=not-a-cursor").status_code == 400
+    assert encode_keyset_cursor(rows[0]) != cursor
+
+def test_account_summary_falls_back_once_function_is_missing():
+    import asyncio
+    from postgrest.exceptions import APIError
+    import app.routers.account as account
+
+    supabase = MagicMock()
+    supabase.rpc.return_value.execute.side_effect = APIError({"message": "not found", "code": "PGRST202"})
+    try:
+        summary = asyncio.run(account._fetch_account_summary(supabase, "test-user-id"))
+        assert account._account_summary_missing
+        assert set(summary) == {"profile", "subscription", "credits", "recent_usage"}
+        supabase.rpc.reset_mock()
+        asyncio.run(account._fetch_account_summary(supabase, "test-user-id"))
+        supabase.rpc.assert_not_called()
+    finally:
+        account._account_summary_missing = False
+
+def test_dataset_listing_keeps_empty_environments():
+    import asyncio
+    import app.routers.ai as ai
+
+    supabase = MagicMock()
+    tables = {
+        "datasets": [{"id": "ds-1", "name": "Shoes", "environment_id": "env-2", "user_id": "u"}],
+        "environments": [{"id": "env-1", "name": "Summer", "user_id": "u"},
+                         {"id": "env-2", "name": "Summit", "user_id": "u"}],
+    }
+    supabase.table.side_effect = lambda name: MagicMock(**{
+        "select.return_value.eq.return_value.execute.return_value.data": tables[name]
+    })
+    ai.dataset_listing_cache.clear()
+    try:
+        datasets, env_name_to_ids, datasets_by_env = asyncio.run(ai._load_dataset_listing(supabase, "u"))
+    finally:
+        ai.dataset_listing_cache.clear()
+    assert env_name_to_ids[ai._normalize_lookup_text("Summer")] == ["env-1"]
+    assert datasets_by_env == {"env-2": datasets}
+
+def test_credit_fallback_retries_lost_balance_race():
+    import app.routers.ai as ai
+
+    supabase = MagicMock()
+    table = supabase.table.return_value
+    table.select.return_value.eq.return_value.execute.side_effect = [
+        MagicMock(data=[{"remaining_credits": 10, "used_credits": 0}]),
+        MagicMock(data=[{"remaining_credits": 9, "used_credits": 1}]),  # Another request won the race
+    ]
+    table.update.return_value.eq.return_value.eq.return_value.eq.return_value.execute.side_effect = [
+        MagicMock(count=0),
+        MagicMock(count=1),
+    ]
+    ai._deduct_credits_tables(supabase, "test-user-id", "generate_image", 2)
+
+    # The retry compares against the balance it re-read
+    last_update = table.update.call_args_list[-1].args[0]
+    assert last_update["remaining_credits"] == 7 and last_update["used_credits"] == 3
+    assert table.update.return_value.eq.return_value.eq.call_args_list[-1].args == ("remaining_credits", 9)
+    table.insert.assert_called()
+
+def test_openapi_schema_lists_lazy_routers():
+    response = client.get("/openapi.json")
+    assert response.status_code == 200
+    paths = response.json()["paths"]
+    assert "/account/usage" in paths
+    assert "/environments/" in paths or "/environments" in paths
+
+def test_env_file_compiled_once(tmp_path):
+    from app import envcompile
+
+    env_file = tmp_path / ".env"
+    env_file.write_text('A=1\nB="two words"\nEMPTY\n')
+    target = tmp_path / "_env_compiled.py"
+    assert envcompile.compile_env(env_file, target) == {"A": "1", "B": "two words"}
+    namespace = {}
+    exec(target.read_text(), namespace)
+    assert namespace["ENV"] == {"A": "1", "B": "two words"}
+    assert envcompile.load_env(tmp_path / "missing.env") == {}
+
+def test_single_flight_coalesces_concurrent_loads():
+    import asyncio
+    from app.cache import SingleFlight
+
+    calls = 0
+
+    async def loader():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return calls
+
+    async def burst():
+        flight = SingleFlight()
+        return await asyncio.gather(*[flight.do("user", loader) for _ in range(5)])
+
+    assert asyncio.run(burst()) == [1] * 5
+    assert calls == 1
+
+def test_stale_while_revalidate_serves_stale_and_refreshes():
+    import asyncio
+    from app.cache import StaleWhileRevalidateCache
+
+    versions = iter(["v1", "v2"])
+
+    async def loader():
+        return next(versions)
+
+    async def scenario():
+        cache = StaleWhileRevalidateCache(maxsize=1, ttl=10, stale_ttl=100)
+        with patch("app.cache.time.monotonic", return_value=0.0):
+            first = await cache.get_or_load("plans", loader)
+        with patch("app.cache.time.monotonic", return_value=20.0):
+            stale = await cache.get_or_load("plans", loader)  # Stale: served, refreshed in the background
+            await asyncio.gather(*cache._tasks)
+            fresh = await cache.get_or_load("plans", loader)
+        return first, stale, fresh
+
+    assert asyncio.run(scenario()) == ("v1", "v1", "v2")
+
+def test_style_aliases_canonicalize_spellings():
+    import app.routers.ai as ai
+
+    assert "oil_painting" in ai.IMAGE_STYLES
+    for spelling in ("oil_painting", "Oil Painting", "oil-painting", "OILPAINTING"):
+        assert ai._STYLE_ALIASES.get(spelling.lower()) == "oil_painting"
+    assert ai._STYLE_ALIASES.get("vaporwave") is None  # Unknown styles pass through